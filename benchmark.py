@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# Benchmarks for sheetMusicPrinter on a generated library.
+# Runs without a display, printer or Ghostscript: the GUI methods are borrowed by a class
+# without widgets and printing goes to a fake ghostscript module. Results are printed as JSON.
+# The GUI module, and with it tkinter, is only imported when the benchmark runs.
+#
+#   python benchmark.py --pieces 2000 --files 30 --output bench.json
+import argparse
+import json
+import logging
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import sheetMusicPrinter as smp
+
+
+titles = [
+    "Bandology", "Olympic Fanfare", "Sæterjentens søndag", "Festmarsj", "Gammel jegermarsj", "Blåveispolka",
+    "Kongesangen", "Norwegian Rhapsody", "Våren", "Hymne til fjellet", "Star Wars Medley", "The Great Escape",
+    "Jubileumsmarsj", "Ja, vi elsker", "Fjellbekken", "Summer Overture", "Viking Saga", "Æresmarsj",
+]
+
+# Instrument names as they appear in real file names, with how many parts are usually written
+instrument_names = [
+    ("Score", 0), ("Partitur", 0), ("Piccolo", 0), ("Flute", 2), ("Fløyte", 2), ("Oboe", 0), ("Bassoon", 0),
+    ("Clarinet in Bb", 3), ("Klarinett", 3), ("Bass Clarinet", 0), ("Alto Sax", 2), ("Altsaksofon", 2),
+    ("Tenor Sax", 0), ("Baritone Sax", 0), ("Horn in F", 4), ("Horn in Eb", 2), ("Trumpet", 3), ("Kornett", 3),
+    ("Trombone", 3), ("Trombone T.C.", 2), ("Bass Trombone", 0), ("Euphonium", 0), ("Baryton T.C.", 0),
+    ("Tuba", 0), ("Tuba in Eb T.C.", 0), ("Bass", 0), ("Timpani", 0), ("Percussion", 2), ("Perkusjon", 2),
+    # Abbreviations and misspellings only the fuzzy classifier finds
+    ("Trpt", 3), ("Klar.", 3), ("Altsakso", 2), ("Euph", 0), ("Timp", 0), ("Perc", 2),
+]
+
+part_formats = ["{}", "{}.", "{}st", "{}"]
+roman = ["I", "II", "III", "IV"]
+
+
+def minimal_pdf():
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R >>",
+        b"<< /Length 18 >>\nstream\n0 0 m 100 100 l S\nendstream",
+    ]
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += "{} 0 obj\n".format(number).encode("ascii") + body + b"\nendobj\n"
+    xref = len(data)
+    data += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1).encode("ascii")
+    for offset in offsets:
+        data += "{:010d} 00000 n \n".format(offset).encode("ascii")
+    data += "trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n".format(len(objects) + 1, xref).encode("ascii")
+    return data
+
+
+def part_name(rng, part):
+    if rng.random() < 0.1:
+        return roman[part - 1]
+    return rng.choice(part_formats).format(part)
+
+
+# Creates pieces folders with about files_per_piece PDFs each, named like the real archive
+def generate_library(root, pieces, files_per_piece, seed=0):
+    rng = random.Random(seed)
+    pdf = minimal_pdf()
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for number in range(pieces):
+        title = "{} {}".format(rng.choice(titles), number)
+        folder = root.joinpath(title)
+        folder.mkdir(exist_ok=True)
+        names = set()
+        while len(names) < files_per_piece:
+            instrument, parts = rng.choice(instrument_names)
+            if parts > 0 and rng.random() < 0.8:
+                name = "{} {} {}".format(title, instrument, part_name(rng, rng.randint(1, parts)))
+            else:
+                name = "{} {}".format(title, instrument)
+            if rng.random() < 0.2:
+                name = name.lower()
+            names.add(name + ".pdf")
+        for name in names:
+            folder.joinpath(name).write_bytes(pdf)
+        total += len(names)
+    return total
+
+
+# Stands in for the ghostscript module, optionally waiting latency seconds per file
+class FakeGhostscript():
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sessions = 0
+        self.files = 0
+
+    def Ghostscript(self, *args):
+        self.sessions += 1
+        return self
+
+    def run_string(self, postscript):
+        self.files += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def exit(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+# The library and printing methods of the GUI, without any widgets.
+# The methods are borrowed from the GUI class by the first HeadlessPrinter created.
+class HeadlessPrinter():
+    gui_methods = ["iter_library_entries", "iter_files_for", "readSheetMusicLibrary", "read_files_for_selected",
+                   "identify_and_sort_files", "print_jobs", "print_all", "submit_print_job"]
+
+    @classmethod
+    def borrow_gui_methods(cls):
+        import sheetMusicPrinterGui
+        for name in cls.gui_methods:
+            setattr(cls, name, getattr(sheetMusicPrinterGui.sheetMusicPrinter, name))
+
+    def __init__(self, path, catalog=None, spooler=None):
+        if not hasattr(HeadlessPrinter, self.gui_methods[0]):
+            self.borrow_gui_methods()
+        self.library_path = path
+        self.catalog = catalog
+        self.spooler = spooler
+        self.ensemble = smp.registry.ensemble()
+        self.libraryEntries = []
+        self.musicfiles = []
+        self.files_by_instrument = []
+        self.selected_search_result = None
+        self.pages_per_minute = 30
+        self.imposer = None
+        self.pdf_info = smp.PdfInfoReader(catalog)
+        self.pdf_infos = {}
+
+    def show_musicfiles(self, musicfiles_names):
+        pass
+
+    def add_widgets_for_besetning(self):
+        pass
+
+    def mark_uncertain(self, uncertain):
+        pass
+
+
+# Runs function repeat times and returns the timings in seconds
+def measure(function, repeat):
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def result(name, timings, items):
+    best = min(timings)
+    return {
+        "name": name,
+        "items": items,
+        "runs": len(timings),
+        "min_s": best,
+        "median_s": statistics.median(timings),
+        "items_per_s": items / best if best > 0 else None,
+    }
+
+
+# Modules the core must not import when it is only used for reading and classifying
+heavy_modules = ["tkinter", "numpy", "pypdf", "ghostscript", "win32print", "ctypes"]
+
+# Times "import sheetMusicPrinter" in fresh interpreters.
+# Also returns which of heavy_modules the import pulled in.
+def measure_import(repeat):
+    script = "import sys, time; started = time.perf_counter(); import sheetMusicPrinter; print(time.perf_counter() - started); print(' '.join(m for m in {!r} if m in sys.modules))".format(heavy_modules)
+    directory = str(pathlib.Path(__file__).resolve().parent)
+    timings = []
+    loaded = ""
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], cwd=directory, check=True, capture_output=True, text=True).stdout.splitlines()
+        timings.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ""
+    return timings, loaded.split()
+
+def run(args, root):
+    results = []
+    timings, loaded = measure_import(max(args.repeat, 5))
+    results.append(result("import sheetMusicPrinter", timings, 1))
+    results[-1]["heavy_modules_loaded"] = loaded
+    started = time.perf_counter()
+    files = generate_library(root, args.pieces, args.files, args.seed)
+    logging.info("Generated {} pieces, {} files in {:.2f} s".format(args.pieces, files, time.perf_counter() - started))
+    rng = random.Random(args.seed)
+
+    plain = HeadlessPrinter(root)
+    results.append(result("readSheetMusicLibrary", measure(lambda: plain.readSheetMusicLibrary(root), args.repeat), args.pieces))
+    pieces = plain.readSheetMusicLibrary(root)
+    selected = [rng.choice(pieces) for i in range(args.selections)]
+
+    def select_all(printer):
+        for piece in selected:
+            printer.selected_search_result = piece
+            printer.read_files_for_selected()
+    results.append(result("read_files_for_selected", measure(lambda: select_all(plain), args.repeat), len(selected)))
+
+    catalog = smp.LibraryCatalog(root, pathlib.Path(root).parent.joinpath("catalog.sqlite"))
+    cataloged = HeadlessPrinter(root, catalog)
+    results.append(result("readSheetMusicLibrary catalog cold", measure(lambda: cataloged.readSheetMusicLibrary(root), 1), args.pieces))
+    results.append(result("readSheetMusicLibrary catalog warm", measure(lambda: cataloged.readSheetMusicLibrary(root), args.repeat), args.pieces))
+    results.append(result("read_files_for_selected catalog cold", measure(lambda: select_all(cataloged), 1), len(selected)))
+    results.append(result("read_files_for_selected catalog warm", measure(lambda: select_all(cataloged), args.repeat), len(selected)))
+    catalog.close()
+
+    all_files = [item for item in pathlib.Path(root).glob("*/*.pdf")]
+    def classify_all():
+        plain.musicfiles = all_files
+        plain.identify_and_sort_files()
+    results.append(result("identify_and_sort_files", measure(classify_all, args.repeat), len(all_files)))
+
+    info_catalog = smp.LibraryCatalog(root, pathlib.Path(root).parent.joinpath("info.sqlite"))
+    reader = smp.PdfInfoReader(info_catalog)
+    results.append(result("pdf info cold", measure(lambda: reader.read(all_files), 1), len(all_files)))
+    results.append(result("pdf info warm", measure(lambda: reader.read(all_files), args.repeat), len(all_files)))
+    reader.close()
+    reader = smp.PdfInfoReader(info_catalog)
+    results.append(result("pdf info from catalog", measure(lambda: reader.read(all_files), 1), len(all_files)))
+    info_catalog.close()
+
+    def plan_all():
+        for piece in selected:
+            plain.selected_search_result = piece
+            plain.read_files_for_selected()
+            plain.print_jobs()
+    results.append(result("read, classify and plan", measure(plan_all, args.repeat), len(selected)))
+
+    fake = FakeGhostscript(args.gs_latency)
+    backend = smp.GhostscriptBackend(smp.GhostscriptPrinter(printer="Benchmark", module=fake))
+    printer = HeadlessPrinter(root, spooler=smp.PrintSpooler(backend, max_queued=len(selected) + 1))
+    def print_all():
+        for piece in selected:
+            printer.selected_search_result = piece
+            printer.read_files_for_selected()
+            printer.pdf_infos = printer.pdf_info.read(printer.musicfiles) # read_page_counts in the GUI
+            printer.print_all()
+        printer.spooler.join()
+    timings = measure(print_all, args.repeat)
+    results.append(result("print_all", timings, len(selected)))
+    results[-1]["ghostscript_sessions"] = fake.sessions
+    results[-1]["ghostscript_files"] = fake.files
+    printer.spooler.close()
+    printer.pdf_info.close()
+    return results, files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sheetMusicPrinter on a generated library")
+    parser.add_argument("--pieces", type=int, default=500, help="Number of piece folders to generate")
+    parser.add_argument("--files", type=int, default=25, help="PDF files per piece")
+    parser.add_argument("--selections", type=int, default=50, help="Pieces selected and printed per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the best and median are reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gs-latency", dest="gs_latency", type=float, default=0.0,
+                        help="Seconds the fake Ghostscript spends per file")
+    parser.add_argument("--library", required=False,
+                        help="Generate the library here and keep it, instead of in a temporary directory")
+    parser.add_argument("--output", required=False, help="Write the JSON results to this file")
+    parser.add_argument("--trace", required=False, help="Write the stage spans of all runs as Chrome trace JSON to this file")
+    parser.add_argument("-d", "--debug", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.loglevel)
+    smp.tracer.enabled = args.trace is not None
+
+    directory = pathlib.Path(args.library) if args.library is not None else pathlib.Path(tempfile.mkdtemp(prefix="smp-bench-"))
+    try:
+        results, files = run(args, directory.joinpath("library"))
+    finally:
+        if args.library is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pieces": args.pieces,
+        "files": files,
+        "selections": args.selections,
+        "results": results,
+    }
+    if args.trace is not None:
+        smp.tracer.write_chrome_trace(args.trace)
+        report["stages"] = smp.tracer.summary().splitlines()
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as stream:
+            stream.write(text + "\n")
+    print(text)
@@ -1,5 +1,9 @@
 # Dependencies:
 # Ghostscript: https://www.ghostscript.com/releases/gsdnld.html
+# pypdf (optional, merged PDFs): https://pypi.org/project/pypdf/
+# NumPy (optional, faster fuzzy classification): https://pypi.org/project/numpy/
+# The GUI is in sheetMusicPrinterGui.py. It and every optional module are only imported when
+# they are used, so the library, classification and batch code start quickly without them.
 
 #!/usr/bin/env python3
 import shutil
@@ -8,60 +12,140 @@ import sys
 import pathlib
 import logging
 import argparse
-import tkinter as tk
-import tkinter.ttk as ttk
-import win32print
+import importlib
 import locale
 import math
+import json
+import hashlib
+import sqlite3
+import threading
+import stat
+import queue
+import time
+import concurrent.futures
+import unicodedata
+import subprocess
+import collections
+import itertools
+import re
+import select
+import struct
+
+# Optional modules by name, None if not installed: ghostscript and win32print for printing on
+# Windows, pypdf for merging and imposition, numpy for the fuzzy classifier (which falls back
+# to plain Python) and ctypes for inotify
+optional_modules = {}
+
+# Imports an optional module the first time it is needed, returns None if it is not installed
+def optional_import(name):
+    if name not in optional_modules:
+        try:
+            optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            optional_modules[name] = None
+    return optional_modules[name]
+
+# One timed stage, count can be set inside the with block to the number of items handled
+class TraceSpan():
+    __slots__ = ("tracer", "name", "args", "count", "started")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.count = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.started, time.perf_counter() - self.started, self.count, self.args)
+
+# Returned by a disabled Tracer, so tracing costs next to nothing when it is off
+class NullSpan():
+    count = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+null_span = NullSpan()
+
+# Records the duration and item count of the slow stages: library read, file glob, classify,
+# widget build and print/convert per file. Spans from all threads are collected, and can be
+# shown as a table per stage or written as Chrome trace JSON (chrome://tracing or Perfetto).
+class Tracer():
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.events = [] # (name, started, seconds, count, args, thread id)
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return null_span
+        return TraceSpan(self, name, args)
+
+    def record(self, name, started, seconds, count=None, args=None):
+        thread = threading.current_thread()
+        with self.lock:
+            self.events.append((name, started, seconds, count, args, thread.ident))
+            self.thread_names[thread.ident] = thread.name
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+
+    # Calls, total, mean and max duration and the summed counts per stage, slowest first
+    def summary(self):
+        with self.lock:
+            events = list(self.events)
+        stages = {}
+        for name, started, seconds, count, args, thread in events:
+            stage = stages.setdefault(name, [0, 0.0, 0.0, None])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+            if count is not None:
+                stage[3] = (stage[3] or 0) + count
+        lines = ["{:<16} {:>6} {:>10} {:>10} {:>10} {:>8}".format("Stage", "Calls", "Total ms", "Mean ms", "Max ms", "Items")]
+        for name, (calls, total, longest, count) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<16} {:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>8}".format(
+                name, calls, 1000 * total, 1000 * total / calls, 1000 * longest, "" if count is None else count))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+        pid = os.getpid()
+        trace = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}} for thread, name in thread_names.items()]
+        for name, started, seconds, count, args, thread in events:
+            event_args = {key: str(value) for key, value in (args or {}).items()}
+            if count is not None:
+                event_args["count"] = count
+            trace.append({"name": name, "ph": "X", "pid": pid, "tid": thread,
+                          "ts": 1e6 * (started - self.origin), "dur": 1e6 * seconds, "args": event_args})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump(self.chrome_trace(), stream)
+        logging.info("Wrote trace of {} spans to {}".format(len(self.events), path))
+
+tracer = Tracer()
 
-try:
-    import ghostscript
-except ModuleNotFoundError:
-    logging.error("No ghostscript module installed, running in test mode")
-
-
-instruments = [
-    ["Score", "Partitur"],
-    ["Piccolo"],
-    ["Flute", "Fløyte"],
-    ["Alto flute"],
-    ["Oboe"],
-    ["Bassoon"],
-    ["Clarinet", "Klarinett"],
-    ["Alto Clarinet", "Alt Klarinett", "Klarinett Alt"],
-    ["Bass Clarinet", "Bass Klarinett", "Klarinett Bass"],
-    ["Alto Sax", "Alto Saxophone", "Alt Saxofon", "Saxofon Alt", "Alt Sax", "Sax Alt", "Altsaxofon", "Altsax", "Altsaksofon"],
-    ["Tenor Sax", "Tenor Saxophone", "Tenor Saxofon", "Saxofon Tenor", "Tenor Sax", "Sax Tenor", "Tenorsax", "Tenorsaxofon", "Tenorsaksofon"],
-    ["Baritone Sax", "Baritone Saxophone", "Baryton Saxofon", "Saxofon Baryton", "Baryton Sax", "Sax Baryton", "Baritonsax", "Barytonsax", "Baritonsaxofon", "Barytonsaxofon", "Barytonsaksofon"],
-    ["Contrabassoon"],
-    ["Horn"],
-    ["Trumpet", "Trompet", "Kornett", "Cornet"],
-    ["Trombone"],
-    ["Bass Trombone"],
-    ["Euphonium"],
-    ["Baritone", "Baryton"],
-    ["Tuba"],
-    ["Bass"],
-    ["Timpani"],
-    ["Percussion", "Perkusjon", "Drums"],
-    ["Harp"],
-    ["Piano","Keyboard"],
-    ["Choir"],
-]
-
-clefs = [
-    ["TC", "T.C.", "G-nøkkel"],
-    ["BC", "B.C.", "F-nøkkel"]
-]
-
-tunings = [
-    ["Bb"],
-    ["Eb"],
-    ["F"],
-    ["C"]
-]
 
 class Instrument():
+    __slots__ = ("name", "tuning", "clef", "part", "amount", "aliases")
+
     def __init__(self, name, tuning, clef, amount=1, part=None):
         self.name = str(name)
         self.tuning = str(tuning)
@@ -76,428 +160,2170 @@ class Instrument():
         else:
             return self.name + " " + str(self.part) + " in " + str(self.tuning) + " (" + str(self.clef) + ")"
 
+# An instrument in the registry, index is its position in files_by_instrument
+class InstrumentSpec():
+    __slots__ = ("index", "name", "aliases", "tuning", "clef")
 
-class Piccolo(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Piccolo", "C", "TC", amount, part)
-
-class Flute(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Flute", "C", "TC", amount, part)
-
-class Clarinet(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Clarinet", "Bb", "TC", amount, part)
-
-class BassClarinet(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Bass Clarinet", "Bb", "TC", amount, part)
-        
-class Bassoon(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Bassoon", "C", "BC", amount, part)
-        
-class AltoSax(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Alto Sax", "Eb", "TC", amount, part)
-        
-class TenorSax(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Tenor Sax", "Bb", "TC", amount, part)
-        
-class BaritoneSax(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Baritone Sax", "Eb", "TC", amount, part)
-        
-class Horn(Instrument):
-    def __init__(self, tuning, amount=1, part=None):
-        Instrument.__init__(self, "Horn", tuning, "TC", amount, part)
-        
-class Trumpet(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Trumpet", "Bb", "TC", amount, part)
-        
-class Trombone(Instrument):
-    def __init__(self, tuning="C", clef="BC", amount=1, part=None):
-        Instrument.__init__(self, "Trombone", tuning=tuning, clef=clef, amount=amount, part=part)
-
-class BassTrombone(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Bass Trombone", "C", "BC", amount, part)
-        
-class Euphonium(Instrument):
-    def __init__(self, clef="BC", amount=1, part=None):
-        Instrument.__init__(self, "Euphonium", "Bb", clef, amount, part)
-        
-class Baritone(Instrument):
-    def __init__(self, clef="BC", amount=1, part=None):
-        Instrument.__init__(self, "Baritone", "Bb", clef, amount, part)
-
-class Tuba(Instrument):
-    def __init__(self, tuning="Bb", clef="BC", amount=1, part=None):
-        Instrument.__init__(self, "Tuba", tuning, clef, amount, part)
-        
-class Bass(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Bass", "C", "BC", amount, part)
-        
-class Timpani(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Timpani", None, "TC", amount, part)
-        
-class Percussion(Instrument):
-    def __init__(self, amount=1, part=None):
-        Instrument.__init__(self, "Percussion", None, None, amount, part)
-
-ohm = []
-ohm.append(Piccolo(1))
-ohm.append(Flute(3))
-ohm.append(BassClarinet(1))
-ohm.append(Bassoon(1))
-ohm.append(AltoSax(3))
-ohm.append(TenorSax(1))
-ohm.append(BaritoneSax(1))
-ohm.append(Horn("Eb", 2))
-ohm.append(Horn("F", 2))
-ohm.append(Trumpet(8))
-ohm.append(Trombone(amount=3))
-ohm.append(Trombone(clef="TC", amount=3))
-ohm.append(BassTrombone(1))
-ohm.append(Euphonium("TC", 3))
-ohm.append(Baritone("TC", 3))
-ohm.append(Tuba("Bb", "TC", 1))
-ohm.append(Tuba("Eb", "TC", 1))
-ohm.append(Tuba("C", "BC", 1))
-ohm.append(Bass(3))
-ohm.append(Percussion(1))
-
-besetning_classes_ohm = ohm
-
-# ØHM
-besetning_ohm = {
-    "Piccolo": 1,
-    "Flute": 3,
-    "Clarinet": 6,
-    "Bass Clarinet": 1,
-    "Bassoon": 1,
-    "Alto Sax": 3,
-    "Tenor Sax": 1,
-    "Baritone Sax": 1,
-    "Horn": 4,
-    "Trumpet": 8,
-    "Trombone": 8,
-    "Bass Trombone": 1,
-    "Euphonium": 4,
-    "Baritone": 4,
-    "Tuba": 3,
-    "Bass": 1,
-    "Timpani": 0,
-    "Percussion": 1
-}
-
-#FHM
-besetning_fhm = {
-    "Piccolo": 1,
-    "Flute": 3,
-    "Clarinet": 4,
-    "Bass Clarinet": 1,
-    "Alto Sax": 2,
-    "Tenor Sax": 1,
-    "Baritone Sax": 0,
-    "Horn": 3,
-    "Trumpet": 6,
-    "Trombone": 2,
-    "Bass Trombone": 1,
-    "Euphonium": 2,
-    "Tuba": 1,
-    "Bass": 1,
-    "Timpani": 0,
-    "Percussion": 0
-}
-
-#FHM
-besetning_fhm_uten_overlapp = {
-    "Piccolo": 1,
-    "Flute": 2,
-    "Clarinet": 3,
-    "Bass Clarinet": 0,
-    "Alto Sax": 1,
-    "Tenor Sax": 1,
-    "Baritone Sax": 0,
-    "Horn": 2,
-    "Trumpet": 4,
-    "Trombone": 2,
-    "Bass Trombone": 1,
-    "Euphonium": 1,
-    "Baritone": 1,
-    "Tuba": 1,
-    "Bass": 1,
-    "Timpani": 0,
-    "Percussion": 1
-}
-
-besetning = besetning_ohm
-
-class sheetMusicPrinter(tk.Tk):
-    def __init__(self, path):
-        tk.Tk.__init__(self)
-        self.library_path = path
-        self.num_search_results = len(instruments)
-        self.title("Sheet Music Printer")
-        self.selected_search_result = "None"
-        self.libraryEntries = []
-        self.musicfiles = []
-        self.files_by_instrument = []
-        self.readSheetMusicLibrary(path)
-        search_label = tk.Label(text="Søk")
-        search_label.grid(row=0, column=0)
-        search_entry = tk.Entry()
-        search_entry.grid(row=1, column=0)
-        var = tk.Variable(value=self.libraryEntries)
-        self.search_results = tk.Listbox(self, listvariable=var, height=self.num_search_results, width=50)
-        self.search_results.grid(row=2, column=0, rowspan=len(instruments))
-        self.search_results.bind('<<ListboxSelect>>', self.search_result_selected)
-        self.selected_search_result_label = tk.Label(text=self.selected_search_result)
-        self.selected_search_result_label.grid(row=0, column=1)
-        self.musicfiles_var = tk.Variable(value=self.musicfiles)
-        self.musicfiles_box = tk.Listbox(self, listvariable=self.musicfiles_var, height=self.num_search_results, width=50)
-        self.musicfiles_box.grid(row=2, column=1, rowspan=len(instruments))
-
-    def add_widgets_for_besetning(self):
-        instrument_label = tk.Label(text="Instrument")
-        instrument_label.grid(row=1, column=2)
-        instrument_label = tk.Label(text="Antall")
-        instrument_label.grid(row=1, column=3)
-        print_button = tk.Button(self, text="Print alle", command=self.print_all)
-        print_button.grid(row=1, column=4)
-
-        # Clean widgets
-        for widget in self.grid_slaves():
-            if int(widget.grid_info()["row"]) > 1 and int(widget.grid_info()["column"]) > 1:
-                widget.grid_forget()
-
-        logging.debug(self.files_by_instrument)
-
-        usingclass = True
-
-        if usingclass == False:
-            # Add new widgets
-            for instrument_row in range(len(instruments)):
-                if len(self.files_by_instrument[instrument_row]) > 0:
-                    logging.debug("Files by instrument[{}]: {}".format(instrument_row, self.files_by_instrument[instrument_row]))
-                    e = tk.Entry(self)
-                    e.grid(row=instrument_row+2, column=2)
-                    e.insert(tk.END, instruments[instrument_row][0])
-                    e = tk.Entry(self)
-                    e.grid(row=instrument_row+2, column=3)
-                    if instruments[instrument_row][0] in besetning:
-                        e.insert(tk.END, besetning[instruments[instrument_row][0]])
-                    else:
-                        e.insert(tk.END, 0)
-                    e = tk.Button(self, text="Print", command= lambda r=instrument_row: self.print_one(self.files_by_instrument[r])) # No worky, instrument_row bytter verdi før knappen trykkes på
-                    e.grid(row=instrument_row+2, column=4)
-                elif (instruments[instrument_row][0] in besetning and besetning[instruments[instrument_row][0]] > 0):
-                    e = tk.Entry(self)
-                    e.grid(row=instrument_row+2, column=2)
-                    e.insert(tk.END, instruments[instrument_row][0])
-                    e =     tk.Entry(self)
-                    e.grid(row=instrument_row+2, column=3)
-                    e.insert(tk.END, "IKKE FUNNET")
+    def __init__(self, index, name, aliases=(), tuning=None, clef=None):
+        self.index = index
+        self.name = name
+        self.aliases = [alias for alias in aliases if alias != name]
+        self.tuning = tuning
+        self.clef = clef
+
+    def instrument(self, amount=1, part=None, tuning=None, clef=None):
+        return Instrument(self.name, tuning if tuning is not None else self.tuning, clef if clef is not None else self.clef, amount, part)
+
+# An ensemble: how many players each instrument has, how they are spread over the parts,
+# and the rows (instrument, tuning, clef, amount) shown in the GUI
+class EnsembleSpec():
+    __slots__ = ("name", "description", "players", "parts", "rows")
+
+    def __init__(self, name, description, players, parts, rows):
+        self.name = name
+        self.description = description
+        self.players = players # instrument name -> players
+        self.parts = parts # instrument name -> {part: players}
+        self.rows = rows # (InstrumentSpec, tuning, clef, amount)
+
+    def instruments(self):
+        return [spec.instrument(amount, tuning=tuning, clef=clef) for spec, tuning, clef, amount in self.rows]
+
+default_registry_path = pathlib.Path(__file__).with_name("instruments.json")
+
+# Instruments, aliases, tunings, clefs and ensembles, read from a JSON file (instruments.json).
+# Adding an instrument alias or an ensemble only needs a change in that file.
+class InstrumentRegistry():
+    def __init__(self, data, path=None):
+        self.path = path
+        self.tunings = [[name] + [alias for alias in aliases if alias != name] for name, aliases in data.get("tunings", {}).items()]
+        self.clefs = [[name] + [alias for alias in aliases if alias != name] for name, aliases in data.get("clefs", {}).items()]
+        self.instruments = []
+        self.by_name = {}
+        self.by_alias = {}
+        for entry in data["instruments"]:
+            spec = InstrumentSpec(len(self.instruments), entry["name"], entry.get("aliases", ()), entry.get("tuning"), entry.get("clef"))
+            self.instruments.append(spec)
+            self.by_name[spec.name] = spec
+            for alias in [spec.name] + spec.aliases:
+                self.by_alias.setdefault(InstrumentClassifier.normalize(alias), spec)
+        self.ensembles = {}
+        for name, entry in data.get("ensembles", {}).items():
+            players = {}
+            for instrument, count in entry.get("players", {}).items():
+                players[self.spec(instrument, name).name] = int(count)
+            parts = {}
+            for instrument, distribution in entry.get("parts", {}).items():
+                parts[self.spec(instrument, name).name] = {int(part): int(count) for part, count in distribution.items()}
+            if "instruments" in entry:
+                rows = [(self.spec(row["instrument"], name), row.get("tuning"), row.get("clef"), int(row.get("amount", 1))) for row in entry["instruments"]]
+            else:
+                rows = [(self.by_name[instrument], None, None, count) for instrument, count in players.items() if count > 0]
+            self.ensembles[name] = EnsembleSpec(name, entry.get("description", name), players, parts, rows)
+        self.default_ensemble = data.get("default_ensemble", next(iter(self.ensembles), None))
+
+    @classmethod
+    def load(cls, path=default_registry_path):
+        with open(path, encoding="utf-8") as stream:
+            return cls(json.load(stream), path)
+
+    def spec(self, name, ensemble=None):
+        if name not in self.by_name:
+            raise ValueError("Unknown instrument \"{}\" in ensemble {}".format(name, ensemble))
+        return self.by_name[name]
+
+    # The instrument names and their aliases, one list per instrument
+    def alias_lists(self):
+        return [[spec.name] + spec.aliases for spec in self.instruments]
+
+    # Returns the instrument with this name or alias, or None
+    def lookup(self, alias):
+        return self.by_alias.get(InstrumentClassifier.normalize(alias))
+
+    def ensemble(self, name=None):
+        return self.ensembles[name if name is not None else self.default_ensemble]
+
+# Classifies file names by the instrument aliases they contain.
+# When several aliases match a name only the longest ones count, so "Bass Clarinet 1.pdf" is a
+# Bass Clarinet and not a Clarinet or a Bass. The aliases are normalized and grouped by length
+# once, longest first, so classifying a name stops at the first length that has a match.
+class InstrumentClassifier():
+    fuzzy_gram_size = 2
+    fuzzy_minimum = 0.5 # files scoring lower are left unclassified
+    fuzzy_confident = 0.6 # fuzzy matches scoring lower are flagged as uncertain and get no copies
+    abbreviation_prefix = 0.7 # least score of a word that starts an alias word, "Klar" for Klarinett
+    abbreviation_letters = 0.6 # least score of a word whose letters are in an alias word in order, "Trpt" for Trumpet
+    word_pattern = re.compile(r"[^\W\d_]+")
+
+    def __init__(self, instruments, ignored_words=()):
+        self.num_instruments = len(instruments)
+        alias_to_instruments = {}
+        for i in range(len(instruments)):
+            for alias in instruments[i]:
+                indices = alias_to_instruments.setdefault(self.normalize(alias), [])
+                if i not in indices:
+                    indices.append(i)
+        lengths = {}
+        for alias, indices in alias_to_instruments.items():
+            lengths.setdefault(len(alias), []).append((alias, indices))
+        self.aliases_by_length = [lengths[length] for length in sorted(lengths, reverse=True)]
+        self.ignored_words = set(word for text in ignored_words for word in self.words(text))
+        self.instruments = instruments
+        self.fuzzy_lock = threading.Lock()
+        self.fuzzy_ready = False
+        # Changes whenever the aliases or the matching change, so stored classifications can be invalidated
+        settings = [instruments, sorted(self.ignored_words), self.fuzzy_gram_size, self.fuzzy_minimum, self.abbreviation_prefix, self.abbreviation_letters]
+        self.signature = hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def normalize(name):
+        return str(name).lower()
+
+    @classmethod
+    def words(cls, text):
+        return cls.word_pattern.findall(cls.normalize(text))
+
+    @classmethod
+    def grams(cls, text):
+        text = " " + text + " "
+        return collections.Counter(text[i:i + cls.fuzzy_gram_size] for i in range(len(text) - cls.fuzzy_gram_size + 1))
+
+    # Character n-gram vectors of every alias, as columns of a matrix with NumPy and as
+    # postings lists (gram -> [(alias, weight)]) without it. The vectors have length 1, so
+    # a dot product is the cosine similarity. Built the first time a name needs fuzzy matching.
+    def build_fuzzy(self):
+        instruments = self.instruments
+        numpy = optional_import("numpy")
+        self.fuzzy_aliases = [] # (alias, instrument index)
+        for i in range(len(instruments)):
+            for alias in instruments[i]:
+                self.fuzzy_aliases.append((" ".join(self.words(alias)), i))
+        self.vocabulary = {}
+        self.postings = {}
+        columns = []
+        for row, (alias, i) in enumerate(self.fuzzy_aliases):
+            grams = self.grams(alias)
+            norm = math.sqrt(sum(count * count for count in grams.values()))
+            for gram, count in grams.items():
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+                self.postings.setdefault(gram, []).append((row, count / norm))
+                columns.append((self.vocabulary[gram], row, count / norm))
+        self.alias_matrix = None
+        if numpy is not None:
+            self.alias_matrix = numpy.zeros((len(self.vocabulary), len(self.fuzzy_aliases)))
+            for gram, row, weight in columns:
+                self.alias_matrix[gram, row] = weight
+        self.alias_words = {} # first letter -> {(alias word, alias length, instrument index)}, for abbreviations
+        for alias, i in self.fuzzy_aliases:
+            for word in alias.split():
+                if len(word) >= 4:
+                    self.alias_words.setdefault(word[0], set()).add((word, len(alias.replace(" ", "")), i))
+        self.abbreviations = {} # word -> (instrument index, score)
+        self.fuzzy_ready = True
+
+    # The words of a file name that may name an instrument, alone and in pairs. The title,
+    # numbers, short words and tuning and clef names are left out.
+    def segments(self, name, title=None):
+        name = self.normalize(os.path.splitext(str(name))[0])
+        if title:
+            name = name.replace(self.normalize(title), " ")
+        words = [word for word in self.words(name) if len(word) >= 3 and word not in self.ignored_words]
+        return words + [first + " " + second for first, second in zip(words, words[1:])]
+
+    # Returns the indices of the instruments whose longest alias occurs in the name
+    def classify_exact(self, name):
+        name = self.normalize(name)
+        for aliases in self.aliases_by_length:
+            matches = []
+            for alias, indices in aliases:
+                if alias in name:
+                    for i in indices:
+                        if i not in matches:
+                            matches.append(i)
+            if len(matches) > 0:
+                matches.sort()
+                return matches
+        return []
+
+    # Returns (alias, score) of the best alias for each list of segments, scoring all
+    # segments of all names against all aliases at once
+    def fuzzy_scores(self, segment_lists):
+        with self.fuzzy_lock:
+            if not self.fuzzy_ready:
+                self.build_fuzzy()
+        numpy = optional_import("numpy")
+        segments = [segment for segment_list in segment_lists for segment in segment_list]
+        best = []
+        if len(segments) > 0 and self.alias_matrix is not None:
+            vectors = numpy.zeros((len(segments), len(self.vocabulary)))
+            for row, segment in enumerate(segments):
+                grams = self.grams(segment)
+                norm = math.sqrt(sum(count * count for count in grams.values()))
+                for gram, count in grams.items():
+                    column = self.vocabulary.get(gram)
+                    if column is not None:
+                        vectors[row, column] = count / norm
+            scores = vectors @ self.alias_matrix
+            aliases = scores.argmax(axis=1)
+            best = list(zip(aliases.tolist(), scores[numpy.arange(len(segments)), aliases].tolist()))
         else:
-            # Add widgets by class
-            row = 2
-            for instrument in besetning_classes_ohm:
-                e = tk.Entry(self)
-                e.grid(row=row, column=2)
-                e.insert(tk.END, str(instrument))
-                e = tk.Entry(self)
-                e.grid(row=row, column=3)
-                e.insert(tk.END, instrument.amount)
-                e = tk.Button(self, text="Print", command= lambda r=instrument: self.print_one(instrument)) # No worky, instrument bytter verdi før knappen trykkes på
-                e.grid(row=row, column=4)
-                row = row + 1
+            for segment in segments:
+                grams = self.grams(segment)
+                norm = math.sqrt(sum(count * count for count in grams.values()))
+                scores = collections.defaultdict(float)
+                for gram, count in grams.items():
+                    for row, weight in self.postings.get(gram, ()):
+                        scores[row] += weight * count / norm
+                best.append(max(scores.items(), key=lambda item: (item[1], -item[0]), default=(None, 0.0)))
+        results = []
+        start = 0
+        for segment_list in segment_lists:
+            candidates = best[start:start + len(segment_list)]
+            start += len(segment_list)
+            results.append(max(candidates, key=lambda item: item[1], default=(None, 0.0)))
+        return results
 
+    # Returns (instrument index, score) for the instrument whose alias words are best
+    # abbreviated by word, or (None, 0.0) if several instruments are abbreviated as well. A word
+    # that starts an alias word scores from abbreviation_prefix, one whose letters are in an
+    # alias word in order, starting with the same letter, from abbreviation_letters, both more
+    # the more of the whole alias they cover, so "Klar" is Klarinett rather than Alt klarinett.
+    def abbreviation(self, word):
+        if word in self.abbreviations:
+            return self.abbreviations[word]
+        scores = {}
+        for alias_word, length, i in self.alias_words.get(word[0], ()):
+            if len(word) >= len(alias_word):
+                continue
+            if alias_word.startswith(word):
+                score = self.abbreviation_prefix
+            else:
+                letters = iter(alias_word)
+                if not all(letter in letters for letter in word):
+                    continue
+                score = self.abbreviation_letters
+            score += (1 - score) * len(word) / length / 2
+            scores[i] = max(scores.get(i, 0.0), score)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        result = (None, 0.0)
+        if len(ranked) == 1 or (len(ranked) > 1 and ranked[0][1] > ranked[1][1]):
+            result = ranked[0]
+        self.abbreviations[word] = result
+        return result
 
-                
+    # Returns (instrument indices, confidence) for each name. Names containing an alias get
+    # confidence 1. The others get the instrument of the most similar alias, scored by the
+    # cosine similarity of their character bigrams, or of the alias words abbreviated by one of
+    # their words if that scores higher, or no instrument below fuzzy_minimum.
+    # title is removed from the names first, titles gives a title per name instead.
+    def match(self, names, title=None, titles=None):
+        if titles is None:
+            titles = [title] * len(names)
+        results = [None] * len(names)
+        pending = []
+        for k, name in enumerate(names):
+            indices = self.classify_exact(name)
+            if len(indices) > 0:
+                results[k] = (indices, 1.0)
+            else:
+                pending.append(k)
+        if len(pending) > 0:
+            segment_lists = [self.segments(names[k], titles[k]) for k in pending]
+            scores = self.fuzzy_scores(segment_lists)
+            for k, segments, (row, score) in zip(pending, segment_lists, scores):
+                instrument = None if row is None else self.fuzzy_aliases[row][1]
+                for segment in segments:
+                    if " " not in segment:
+                        abbreviated, abbreviation_score = self.abbreviation(segment)
+                        if abbreviation_score > score:
+                            instrument, score = abbreviated, abbreviation_score
+                if instrument is None or score < self.fuzzy_minimum:
+                    results[k] = ([], score)
+                else:
+                    results[k] = ([instrument], score)
+        return results
 
+    # Returns the indices of the instruments matching the name, see match
+    def classify(self, name, title=None):
+        return self.match([name], title)[0][0]
 
+    def is_confident(self, confidence):
+        return confidence >= self.fuzzy_confident
 
+    # Matches paths, with the folder of each file (the piece) as its title
+    def match_files(self, files):
+        paths = [os.fspath(file) for file in files]
+        return self.match([os.path.basename(path) for path in paths], titles=[os.path.basename(os.path.dirname(path)) for path in paths])
 
-    def run(self):
-        self.mainloop()
+    # Returns (file, instrument indices, confidence) for the files that are unclassified or
+    # only matched with low confidence. classifications are the results of match for the
+    # files if they are already known.
+    def uncertain(self, files, classifications=None):
+        if classifications is None:
+            classifications = self.match_files(files)
+        flagged = []
+        for file, (indices, confidence) in zip(files, classifications):
+            if not self.is_confident(confidence):
+                flagged.append((file, indices, confidence))
+        return flagged
 
-    # Read folders in sheet music library and populate the list of entries
-    def readSheetMusicLibrary(self, path):
-        libraryEntries = []
-        try:
-            for item in path.iterdir():
-                if item.is_dir():
-                    libraryEntries.append(str(item.name))
-            self.libraryEntries = libraryEntries
-        except FileNotFoundError:
-            logging.error("Sheet Music Library Path not found")
-        return libraryEntries
-
-    def search_result_selected(self, event):
-        selected_indices = self.search_results.curselection()
-        self.selected_search_result = self.search_results.get(selected_indices[0])
-        self.selected_search_result_label.config(text=self.selected_search_result)
-        logging.info("{}".format(self.selected_search_result))
-        self.read_files_for_selected()
-
-    def read_files_for_selected(self):
-        musicfiles = []
-        path = self.library_path.joinpath(pathlib.Path(self.selected_search_result))
-        logging.info("Selected music path: {}".format(path))
-        pdf_files = path.glob('*pdf')
-        for item in pdf_files:
-            if item.is_file():
-                #musicfiles.append(item.name)
-                musicfiles.append(item)
-        self.musicfiles = musicfiles
-        musicfiles_names = []
-        for file in musicfiles:
-            musicfiles_names.append(file.name)
-        
-        self.musicfiles_var = tk.Variable(value=musicfiles_names)
-        self.musicfiles_box.config(listvariable=self.musicfiles_var)
-        self.identify_and_sort_files()
-        return musicfiles
-    
-    def identify_and_sort_files(self):
+    # Sorts the files into one list per instrument, in the order the files are given.
+    # Uncertain guesses are left out, so they never take the copies of a part.
+    def sort_files(self, files):
+        return self.sort_classified(files, self.match_files(files))
+
+    # Same as sort_files, but with the (instrument indices, confidence) of each file already known
+    def sort_classified(self, files, classifications):
         files_by_instrument = []
-        for i in range(0, len(instruments)):
+        for i in range(0, self.num_instruments):
             files_by_instrument.append([])
-        for file in self.musicfiles:
-            for i in range(0, len(instruments)):
-                for instrument_variation in instruments[i]:
-                    if instrument_variation.lower() in str(file.name).lower():
-                        # We have found a file matching the instrument, but it might match multiple instruments
-                        # Find which is the longest instrument name that matches
-                        unique = True
-                        for j in range(0, len(instruments)): # iterate over all instruments again
-                            for instrument_variation_check in instruments[j]: # iterate over all instrument variations again
-                                # If there exists a longer instrument variant name that matches than the current match, don't add it to the list
-                                if len(instrument_variation_check) > len(instrument_variation) and instrument_variation_check.lower() in str(file.name).lower():
-                                    logging.info("{} > {}".format(instrument_variation_check, instrument_variation))
-                                    unique = False
-                        if unique:
-                            files_by_instrument[i].append(file)
-        for instrument in files_by_instrument: # DEBUG
-            logging.info(instrument)
-        self.files_by_instrument = files_by_instrument
-        self.add_widgets_for_besetning()
+        for file, (indices, confidence) in zip(files, classifications):
+            if not self.is_confident(confidence):
+                continue
+            for i in indices:
+                files_by_instrument[i].append(file)
         return files_by_instrument
 
-    def identify_voice(self):
-        for i in range (0, len(instruments)):
-            # if we have more than one file for a given instrument there is more than one voice
-            if len(self.files_by_instrument[i]) > 1:
-                for file in self.files_by_instrument[i]:
-                    for voice in range(0, 6): # Magic number WARNING, checking up to 6 numbered voices per instrument
-                        if voice in str(file.name).lower().replace(self.selected_search_result, ''): # First remove the title of the music in case that contains numbers
-                            pass #TODO
+# Finds part (voice) numbers, tuning and clef in file names.
+# The title of the piece and the file extension are removed first, so numbers in the title
+# are not taken for parts. "Trumpet 1", "1st Trumpet", "Trumpet I", "Trumpet 1/2" and
+# "Trumpet 1-3" are all understood, a range covers every part in it.
+class PartDetector():
+    number_pattern = r"(?:[1-9](?:st|nd|rd|th|\.)?)"
+    part_pattern = re.compile(r"(?<![\w.])({0}(?:\s*(?:/|&|\+|,|-|og|and)\s*{0})*)(?!\w)".format(number_pattern), re.IGNORECASE)
+    roman_pattern = re.compile(r"(?<![\w.])(I{1,3}|IV|V|VI)(?![\w])") # Case sensitive, "i" is a word
+    roman_numbers = {"I": 1, "II": 2, "III": 3, "IV": 4, "V": 5, "VI": 6}
+    score_pattern = re.compile(r"\b(score|partitur|conductor|dirigent|direktion)\b", re.IGNORECASE)
+
+    def __init__(self, tunings, clefs):
+        # Longest names first so "T.C." wins over "TC"
+        self.tuning_patterns = [(tuning[0], re.compile(r"(?<!\w)(?:in\s+)?(?:{})(?!\w)".format("|".join(re.escape(name) for name in sorted(tuning, key=len, reverse=True)))))
+                                for tuning in tunings]
+        self.clef_patterns = [(clef[0], re.compile(r"(?<!\w)(?:{})(?!\w)".format("|".join(re.escape(name) for name in sorted(clef, key=len, reverse=True))), re.IGNORECASE))
+                              for clef in clefs]
+
+    # Removes the extension, the title, clefs and tunings, which can all contain numbers or letters that look like parts
+    def strip(self, name, title=None):
+        name = os.path.splitext(str(name))[0]
+        if title:
+            name = re.sub(re.escape(str(title)), " ", name, flags=re.IGNORECASE)
+        for clef, pattern in self.clef_patterns:
+            name = pattern.sub(" ", name)
+        for tuning, pattern in self.tuning_patterns:
+            name = pattern.sub(" ", name)
+        return name
+
+    # Returns the sorted part numbers in the name, empty if it has none
+    def parts(self, name, title=None):
+        name = self.strip(name, title)
+        parts = set()
+        for match in self.part_pattern.finditer(name):
+            numbers = re.findall(r"[1-9]", match.group(1))
+            separators = re.findall(r"/|&|\+|,|-|og|and", match.group(1), re.IGNORECASE)
+            parts.add(int(numbers[0]))
+            for separator, first, last in zip(separators, numbers, numbers[1:]):
+                if separator == "-":
+                    parts.update(range(int(first), int(last) + 1))
+                else:
+                    parts.add(int(last))
+        if len(parts) == 0:
+            for match in self.roman_pattern.finditer(name):
+                parts.add(self.roman_numbers[match.group(1)])
+        return tuple(sorted(parts))
+
+    # Returns what sets a file apart from other files of the same instrument, besides its part
+    # numbers: the other words of the name, the tuning and the clef. "Horn in F 1" and "Horn in
+    # Eb 1" are different voices, as are "Trumpet 1" and "Cornet 1", but "1st Trumpet" and
+    # "Trumpet 1-2" are the same voice as "Trumpet 1".
+    def voice(self, name, title=None):
+        words = self.roman_pattern.sub(" ", self.part_pattern.sub(" ", self.strip(name, title)))
+        return (" ".join(InstrumentClassifier.words(words)), self.tuning(name), self.clef(name))
+
+    def tuning(self, name):
+        name = os.path.splitext(str(name))[0]
+        for clef, pattern in self.clef_patterns:
+            name = pattern.sub(" ", name)
+        for tuning, pattern in self.tuning_patterns:
+            if pattern.search(name):
+                return tuning
+        return None
+
+    def clef(self, name):
+        for clef, pattern in self.clef_patterns:
+            if pattern.search(str(name)):
+                return clef
+        return None
+
+    def is_score(self, name):
+        return self.score_pattern.search(str(name)) is not None
+
+    # Describes a file as an Instrument with its part, tuning and clef
+    def instrument(self, file, title, instrument_index):
+        parts = self.parts(file.name, title)
+        if len(parts) == 0:
+            part = None
+        elif len(parts) == 1:
+            part = parts[0]
+        else:
+            part = "/".join(str(p) for p in parts)
+        return registry.instruments[instrument_index].instrument(part=part, tuning=self.tuning(file.name), clef=self.clef(file.name))
+
+# Reads the registry and rebuilds the classifier and part detector from it
+def load_registry(path=default_registry_path):
+    global registry, instrument_classifier, part_detector
+    registry = InstrumentRegistry.load(path)
+    ignored_words = [alias for aliases in registry.tunings + registry.clefs for alias in aliases]
+    instrument_classifier = InstrumentClassifier(registry.alias_lists(), ignored_words)
+    part_detector = PartDetector(registry.tunings, registry.clefs)
+    return registry
+
+load_registry()
+
+# Warns about the (file, instrument indices, confidence) of InstrumentClassifier.uncertain
+def log_uncertain(uncertain):
+    for file, indices, confidence in uncertain:
+        if len(indices) > 0:
+            logging.warning("Unsure of the instrument of {}, not printed: {} ({:.2f})".format(file.name, registry.instruments[indices[0]].name, confidence))
+        else:
+            logging.warning("No instrument found for {}".format(file.name))
+
+# Splits total over the weights, largest remainder first, so the parts always add up to total
+def allocate(total, weights):
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        weights = [1] * len(weights)
+        weight_sum = len(weights)
+    shares = [total * weight / weight_sum for weight in weights]
+    counts = [math.floor(share) for share in shares]
+    order = sorted(range(len(weights)), key=lambda i: (counts[i] - shares[i], i))
+    for i in order[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+# Returns (file, copies) for the files of one instrument, giving one copy per player.
+# The players are spread over the parts found in the file names, by distribution ({part: players})
+# if given and evenly otherwise. Each part is printed from the file that covers the fewest
+# parts, so "Trumpet 1.pdf" is used for part 1 even when there is also a "Trumpet 1-2.pdf".
+# Parts are told apart by voice as well as number, so "Horn in F 1" and "Horn in Eb 1" are
+# both printed. A file without a part number counts as a part of its own. A part left without players, when
+# there are fewer players than parts or the distribution does not list it, still gets one copy.
+def plan_part_copies(files, players, title=None, distribution=None):
+    if players <= 0:
+        return []
+    parts_by_file = [] # (file, [(voice, part number)])
+    for file in files:
+        voice = part_detector.voice(file.name, title)
+        parts_by_file.append((file, [(voice, part) for part in part_detector.parts(file.name, title)]))
+    all_parts = sorted(set(part for file, parts in parts_by_file for part in parts), key=lambda part: (part[1], repr(part[0])))
+    if distribution and len(all_parts) > 0:
+        weights = [distribution.get(part, 0) for voice, part in all_parts]
+        unnumbered_weight = sum(weights) / len(weights)
+    else:
+        weights = [1] * len(all_parts)
+        unnumbered_weight = 1
+    unnumbered = [file for file, parts in parts_by_file if len(parts) == 0]
+    counts = allocate(players, weights + [unnumbered_weight] * len(unnumbered))
+    sources = []
+    for part in all_parts:
+        file, parts = min((candidate for candidate in parts_by_file if part in candidate[1]), key=lambda candidate: len(candidate[1]))
+        sources.append(file)
+    sources += unnumbered
+    left_out = [file.name for file, count in zip(sources, counts) if count == 0]
+    if len(left_out) > 0:
+        logging.warning("No players left for {}, printing one copy each".format(", ".join(left_out)))
+        counts = [max(1, count) for count in counts]
+    copies = {}
+    for file, part_players in zip(sources, counts):
+        copies[file] = copies.get(file, 0) + part_players
+    return [(file, copies[file]) for file in files if copies.get(file, 0) > 0]
+
+# Returns (file, copies) for every file needed by the ensemble.
+# Files that look like scores are left out of the other instruments.
+def plan_copies(files_by_instrument, ensemble, title=None):
+    jobs = []
+    for spec in registry.instruments:
+        players = ensemble.players.get(spec.name, 0)
+        if ( len(files_by_instrument[spec.index]) > 0 ) and (players > 0):
+            files = files_by_instrument[spec.index]
+            if spec.name != "Score":
+                files = [file for file in files if not part_detector.is_score(file.name)]
+            if len(files) == 0:
+                continue
+            jobs += plan_part_copies(files, players, title, ensemble.parts.get(spec.name))
+    return jobs
+
+default_catalog_path = pathlib.Path.home().joinpath(".sheetMusicPrinter", "catalog.sqlite")
+
+# SQLite index of the pieces in the library and their PDF files.
+# A directory is only listed again when its mtime differs from the one stored at the last
+# scan, so on a slow network drive most reads are served from the database.
+class LibraryCatalog():
+    def __init__(self, library_path, database_path=default_catalog_path, classifier=None):
+        self.library_path = pathlib.Path(library_path)
+        self.classifier = classifier if classifier is not None else instrument_classifier
+        if str(database_path) != ":memory:":
+            pathlib.Path(database_path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(database_path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pieces (name TEXT PRIMARY KEY, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                    "piece TEXT, name TEXT, size INTEGER, mtime REAL, instruments TEXT, confidence REAL, "
+                                    "PRIMARY KEY (piece, name))")
+            if "confidence" not in [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]:
+                # Catalog from before confidences were stored, filled in by reclassify
+                self.connection.execute("ALTER TABLE files ADD COLUMN confidence REAL")
+                self.connection.execute("DELETE FROM meta WHERE key = 'classifier'")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pdf_info ("
+                                    "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, pages INTEGER, width REAL, height REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS file_hashes ("
+                                    "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)")
+            if self.get_meta("library_path") != str(self.library_path):
+                # Another library, nothing stored is valid
+                self.connection.execute("DELETE FROM pieces")
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("DELETE FROM pdf_info")
+                self.connection.execute("DELETE FROM file_hashes")
+                self.connection.execute("DELETE FROM meta")
+                self.set_meta("library_path", str(self.library_path))
+            if self.get_meta("classifier") != self.classifier.signature:
+                self.reclassify()
+                self.set_meta("classifier", self.classifier.signature)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @staticmethod
+    def encode_instruments(indices):
+        return ",".join(str(i) for i in indices)
+
+    @staticmethod
+    def decode_instruments(text):
+        return [int(i) for i in text.split(",")] if text else []
+
+    def reclassify(self):
+        rows = self.connection.execute("SELECT piece, name FROM files").fetchall()
+        classifications = self.classifier.match([name for piece, name in rows], titles=[piece for piece, name in rows])
+        self.connection.executemany("UPDATE files SET instruments = ?, confidence = ? WHERE piece = ? AND name = ?",
+                                    [(self.encode_instruments(indices), confidence, piece, name)
+                                     for (piece, name), (indices, confidence) in zip(rows, classifications)])
+
+    # Returns the stored PdfInfo of a file if it has not changed since, otherwise None
+    def get_pdf_info(self, path, size, mtime):
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, pages, width, height FROM pdf_info WHERE path = ?", (str(path),)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        return PdfInfo(row[2], row[3], row[4], row[0])
+
+    # Stores (path, mtime, PdfInfo) tuples
+    def put_pdf_info(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO pdf_info (path, size, mtime, pages, width, height) VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(str(path), info.size, mtime, info.pages, info.width, info.height) for path, mtime, info in entries])
+
+    # Returns the stored SHA-256 of a file if it has not changed since, otherwise None
+    def get_file_hash(self, path, size, mtime):
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, sha256 FROM file_hashes WHERE path = ?", (str(path),)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        return row[2]
+
+    def put_file_hash(self, path, size, mtime, sha256):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                                    (str(path), size, mtime, sha256))
+
+    # Returns the names of the pieces (folders) in the library
+    def read_pieces(self):
+        return list(self.iter_pieces())
+
+    # Yields the names of the pieces as they are found. The catalog is only updated when the
+    # generator runs to the end, so a scan that is abandoned halfway leaves it untouched.
+    def iter_pieces(self):
+        mtime = self.library_path.stat().st_mtime
+        with self.lock:
+            if self.get_meta("library_mtime") == repr(mtime):
+                names = [row[0] for row in self.connection.execute("SELECT name FROM pieces ORDER BY name COLLATE NOCASE")]
+            else:
+                names = None
+        if names is not None:
+            yield from names
+            return
+        logging.info("Library changed, rescanning {}".format(self.library_path))
+        names = []
+        for item in self.library_path.iterdir():
+            if item.is_dir():
+                names.append(str(item.name))
+                yield str(item.name)
+        with self.lock, self.connection:
+            stored = set(row[0] for row in self.connection.execute("SELECT name FROM pieces"))
+            for name in stored.difference(names):
+                self.connection.execute("DELETE FROM pieces WHERE name = ?", (name,))
+                self.connection.execute("DELETE FROM files WHERE piece = ?", (name,))
+            for name in set(names).difference(stored):
+                # A NULL mtime means the files of the piece have not been scanned yet
+                self.connection.execute("INSERT INTO pieces (name, mtime) VALUES (?, NULL)", (name,))
+            self.set_meta("library_mtime", repr(mtime))
+
+    # Returns (path, (instrument indices, confidence)) for the PDF files of a piece
+    def read_files(self, piece):
+        return list(self.iter_files(piece))
+
+    # Yields (path, (instrument indices, confidence)) for the PDF files of a piece as they are found
+    def iter_files(self, piece):
+        path = self.library_path.joinpath(pathlib.Path(piece))
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            logging.error("Piece not found: {}".format(path))
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM pieces WHERE name = ?", (piece,))
+                self.connection.execute("DELETE FROM files WHERE piece = ?", (piece,))
+            return
+        with self.lock:
+            row = self.connection.execute("SELECT mtime FROM pieces WHERE name = ?", (piece,)).fetchone()
+            if row is not None and row[0] == mtime:
+                rows = self.connection.execute("SELECT name, instruments, confidence FROM files WHERE piece = ? ORDER BY name COLLATE NOCASE", (piece,)).fetchall()
+            else:
+                rows = None
+        if rows is not None:
+            for name, instruments, confidence in rows:
+                yield (path.joinpath(name), (self.decode_instruments(instruments), confidence))
+            return
+        logging.info("Piece changed, rescanning {}".format(path))
+        rows = []
+        for item in path.glob('*pdf'):
+            item_stat = item.stat()
+            if not stat.S_ISREG(item_stat.st_mode):
+                continue
+            indices, confidence = self.classifier.match([item.name], piece)[0]
+            rows.append((piece, item.name, item_stat.st_size, item_stat.st_mtime, self.encode_instruments(indices), confidence))
+            yield (item, (indices, confidence))
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM files WHERE piece = ?", (piece,))
+            self.connection.executemany("INSERT INTO files (piece, name, size, mtime, instruments, confidence) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO pieces (name, mtime) VALUES (?, ?)", (piece, mtime))
+
+# Linux inotify through libc, for LibraryWatcher. Raises OSError where it is not available.
+class Inotify():
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    changes = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    event_header = struct.Struct("iIII") # wd, mask, cookie, length of the name
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.ctypes = optional_import("ctypes")
+        if self.ctypes is None or optional_import("ctypes.util") is None:
+            raise OSError("ctypes is not available")
+        self.libc = self.ctypes.CDLL(self.ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.ctypes.get_errno(), "inotify_init1 failed")
+
+    def fileno(self):
+        return self.fd
+
+    def add(self, path, mask=changes):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), "inotify_add_watch failed", str(path))
+        return wd
+
+    def remove(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Returns the pending (wd, mask, name) events
+    def read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# Keeps the library view up to date while the program runs.
+# Compares the library folder, and the folder of the piece being shown, with what it saw last
+# time and reports only the differences to changed(kind, payload):
+#   "entries_added" / "entries_removed": lists of piece names
+#   "files_added" / "files_changed": (piece, [(path, (instrument indices, confidence))])
+#   "files_removed": (piece, [path])
+# The folders are compared every interval seconds. On Linux inotify also triggers a comparison
+# as soon as something changes locally. Network mounts often send no events for changes made
+# elsewhere, so the polling keeps running as a fallback.
+class LibraryWatcher():
+    def __init__(self, library_path, changed, interval=5.0, use_inotify=True, classifier=None):
+        self.library_path = pathlib.Path(library_path)
+        self.changed = changed
+        self.interval = interval
+        self.classifier = classifier if classifier is not None else instrument_classifier
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.wake_read = self.wake_write = None # pipe to wake up select on the inotify file, Linux only
+        self.pieces = None
+        self.piece = None # piece whose files are watched
+        self.requested_piece = None
+        self.files = {} # name -> (size, mtime) of the files of piece
+        self.inotify = None
+        self.library_wd = None
+        self.piece_wd = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+                self.library_wd = self.inotify.add(self.library_path)
+                self.wake_read, self.wake_write = os.pipe()
+                os.set_blocking(self.wake_write, False)
+            except OSError as error:
+                logging.info("Watching {} by polling: {}".format(self.library_path, error))
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+        self.thread = threading.Thread(target=self.run, name="watcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.wake()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+        if not self.thread.is_alive() and self.wake_read is not None:
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+    def wake(self):
+        self.wakeup.set()
+        if self.wake_write is not None:
+            try:
+                os.write(self.wake_write, b"x")
+            except BlockingIOError: # Full of wake ups nobody has read yet
+                pass
+
+    # Watches the files of piece from now on instead of the previous one
+    def watch_piece(self, piece):
+        with self.lock:
+            self.requested_piece = piece
+        if not self.stopping.is_set():
+            self.wake()
+
+    # Falls back to polling when inotify fails
+    def stop_inotify(self):
+        if self.inotify is not None:
+            self.inotify.close()
+        self.inotify = None
+        self.library_wd = None
+        self.piece_wd = None
+
+    def list_pieces(self):
+        return set(str(item.name) for item in self.library_path.iterdir() if item.is_dir())
+
+    def list_files(self, piece):
+        files = {}
+        for item in self.library_path.joinpath(piece).glob('*pdf'):
+            try:
+                item_stat = item.stat()
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(item_stat.st_mode):
+                files[item.name] = (item_stat.st_size, item_stat.st_mtime)
+        return files
+
+    def check_pieces(self):
+        pieces = self.list_pieces()
+        if self.pieces is not None:
+            added = sorted(pieces.difference(self.pieces), key=str.casefold)
+            removed = sorted(self.pieces.difference(pieces), key=str.casefold)
+            if len(added) > 0:
+                self.changed("entries_added", added)
+            if len(removed) > 0:
+                self.changed("entries_removed", removed)
+        self.pieces = pieces
+
+    def check_files(self):
+        with self.lock:
+            requested = self.requested_piece
+        if requested != self.piece:
+            # A new piece is shown, its files were just read, so start from what is there now
+            if self.piece_wd is not None:
+                self.inotify.remove(self.piece_wd)
+                self.piece_wd = None
+            self.piece = requested
+            self.files = {}
+            if self.piece is not None:
+                if self.inotify is not None:
+                    try:
+                        self.piece_wd = self.inotify.add(self.library_path.joinpath(self.piece))
+                    except OSError as error:
+                        logging.debug("Not watching {}: {}".format(self.piece, error))
+                try:
+                    self.files = self.list_files(self.piece)
+                except OSError:
+                    self.files = {}
+            return
+        if self.piece is None:
+            return
+        try:
+            files = self.list_files(self.piece)
+        except OSError:
+            files = {}
+        path = self.library_path.joinpath(self.piece)
+        added = [name for name in files if name not in self.files]
+        removed = [name for name in self.files if name not in files]
+        modified = [name for name in files if name in self.files and files[name] != self.files[name]]
+        self.files = files
+        if len(added) > 0:
+            added.sort(key=str.casefold)
+            self.changed("files_added", (self.piece, list(zip([path.joinpath(name) for name in added], self.classifier.match(added, self.piece)))))
+        if len(modified) > 0:
+            self.changed("files_changed", (self.piece, list(zip([path.joinpath(name) for name in modified], self.classifier.match(modified, self.piece)))))
+        if len(removed) > 0:
+            self.changed("files_removed", (self.piece, [path.joinpath(name) for name in removed]))
+
+    # Waits up to timeout seconds for inotify events or a wake up, returns what to check.
+    # Without inotify only the wake up event is waited for, select does not take pipes on Windows.
+    def wait(self, timeout):
+        if self.inotify is None:
+            woken = self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            return False, woken
+        ready, writers, errors = select.select([self.wake_read, self.inotify], [], [], timeout)
+        check_pieces = False
+        check_files = False
+        if self.wake_read in ready:
+            os.read(self.wake_read, 1024)
+            self.wakeup.clear()
+            check_files = True
+        if self.inotify in ready:
+            for wd, mask, name in self.inotify.read():
+                if wd == self.library_wd:
+                    check_pieces = True
+                elif wd == self.piece_wd:
+                    check_files = True
+        return check_pieces, check_files
+
+    def run(self):
+        next_poll = time.monotonic()
+        try:
+            while not self.stopping.is_set():
+                now = time.monotonic()
+                poll = now >= next_poll
+                if poll:
+                    next_poll = now + self.interval
+                    check_pieces, check_files = True, True
+                else:
+                    try:
+                        check_pieces, check_files = self.wait(next_poll - now)
+                    except OSError as error:
+                        logging.warning("Waiting for changes in {} failed, polling instead: {}".format(self.library_path, error))
+                        self.stop_inotify()
+                        continue
+                    if self.stopping.is_set():
+                        break
+                try:
+                    with tracer.span("watch", poll=poll):
+                        if check_pieces:
+                            self.check_pieces()
+                        if check_files:
+                            self.check_files()
+                except OSError as error:
+                    logging.warning("Watching {} failed: {}".format(self.library_path, error))
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+# One Ghostscript interpreter kept open for a whole print job.
+# The python ghostscript module only allows one interpreter at a time, so use it as a context
+# manager and do not open two sessions at once.
+class GhostscriptSession():
+    encoding = locale.getpreferredencoding()
+
+    def __init__(self, args, module=None):
+        self.module = module if module is not None else optional_import("ghostscript")
+        if self.module is None:
+            raise RuntimeError("No ghostscript module installed")
+        # The first argument is the program name, Ghostscript ignores it
+        args = ["sheetMusicPrinter"] + list(args)
+        logging.debug(args)
+        self.instance = self.module.Ghostscript(*[a.encode(self.encoding) for a in args])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, postscript):
+        logging.debug(postscript)
+        self.instance.run_string(postscript.encode(self.encoding))
+
+    def close(self):
+        if self.instance is not None:
+            self.instance.exit()
+            self.module.cleanup()
+            self.instance = None
+
+    @staticmethod
+    def ps_string(text):
+        return "(" + str(text).replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+    @staticmethod
+    def ps_path(file):
+        # Ghostscript accepts forward slashes on Windows as well
+        return GhostscriptSession.ps_string(pathlib.PureWindowsPath(file).as_posix())
+
+    # Running files from PostScript needs read permission with -dSAFER
+    @staticmethod
+    def permit_read(files):
+        args = []
+        for directory in sorted(set(str(pathlib.Path(file).parent) for file in files)):
+            args.append("--permit-file-read={}/".format(pathlib.PureWindowsPath(directory).as_posix()))
+        return args
+
+# Time spent on each file of a print job
+class PrintReport():
+    def __init__(self):
+        self.entries = [] # (file, copies, seconds)
+        self.seconds = 0.0
+        self.imposition = None # ImpositionPlan of the job, if it was imposed
+
+    def add(self, file, copies, seconds):
+        self.entries.append((file, copies, seconds))
+
+    def copies(self):
+        return sum(copies for file, copies, seconds in self.entries)
+
+    def summary(self):
+        lines = []
+        for file, copies, seconds in self.entries:
+            lines.append("{:>7.2f} s  {:>3} x  {}".format(seconds, copies, pathlib.Path(file).name))
+        rate = 60 * self.copies() / self.seconds if self.seconds > 0 else 0
+        lines.append("{:>7.2f} s  {:>3} x  {} files, {:.1f} copies/min".format(self.seconds, self.copies(), len(self.entries), rate))
+        if self.imposition is not None:
+            lines.append(self.imposition.summary())
+        return "\n".join(lines)
+
+default_print_cache_path = pathlib.Path.home().joinpath(".sheetMusicPrinter", "print-cache")
+
+# Disk cache of files converted to printer language by Ghostscript.
+# Entries are keyed by the SHA-256 of the source file and the conversion arguments, so an
+# unchanged file printed with the same settings is never converted twice. The least recently
+# used entries are removed when the cache grows past max_bytes.
+class PrintReadyCache():
+    suffix = ".prn"
+
+    def __init__(self, directory=default_print_cache_path, max_bytes=1024 * 1024 * 1024):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hashes = {} # (path, size, mtime) -> content hash, saves reading unchanged files again
+
+    def content_hash(self, file):
+        file_stat = os.stat(file)
+        memo_key = (str(file), file_stat.st_size, file_stat.st_mtime_ns)
+        if memo_key not in self.hashes:
+            digest = hashlib.sha256()
+            with open(file, "rb") as stream:
+                for block in iter(lambda: stream.read(1024 * 1024), b""):
+                    digest.update(block)
+            self.hashes[memo_key] = digest.hexdigest()
+        return self.hashes[memo_key]
+
+    # Output files and read permissions do not change the result
+    @staticmethod
+    def normalize_args(args):
+        normalized = []
+        for arg in args:
+            arg = arg.strip().replace("=", "#", 1)
+            if arg.startswith("-sOutputFile#") or arg.startswith("--permit-file-read"):
+                continue
+            normalized.append(arg)
+        return normalized
+
+    def key(self, file, args):
+        digest = hashlib.sha256(self.content_hash(file).encode("ascii"))
+        digest.update("\0".join(self.normalize_args(args)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.directory.joinpath(key + self.suffix)
+
+    # Returns the cached file for the key, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path) # Most recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Moves a converted file into the cache
+    def put(self, key, file):
+        path = self.path(key)
+        os.replace(file, path)
+        return path
+
+    # Removes the least recently used entries until the cache fits, except those in keep.
+    # Other processes may share the directory, so entries can disappear while this runs.
+    def evict(self, keep=()):
+        keep = set(pathlib.Path(path) for path in keep)
+        entries = []
+        total = 0
+        for entry in self.directory.glob("*" + self.suffix):
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            total += entry_stat.st_size
+            if entry not in keep:
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry))
+        entries.sort()
+        while total > self.max_bytes and len(entries) > 0:
+            mtime, size, entry = entries.pop(0)
+            logging.debug("Evicting {} from the print cache".format(entry.name))
+            entry.unlink(missing_ok=True)
+            total -= size
+
+default_staging_path = pathlib.Path.home().joinpath(".sheetMusicPrinter", "staging")
+
+# Local copies of library files, so a library on a slow network mount is read ahead of the
+# printer instead of while it waits. prefetch copies the files on a thread pool when a piece
+# is selected, localize returns the copies to print, waiting for those still on their way.
+# A copy is used again while the source keeps its size and modification time. Its SHA-256
+# is compared with the one in the catalog, so a damaged copy is never printed. The first
+# copy of a file reads the source a second time and stores the hash only if both reads
+# agree, so one bad read does not become the reference. The least recently used files are
+# removed when the cache grows past max_bytes, except those of the last prefetched piece
+# and those localized for jobs still printing.
+class StagingCache():
+    suffix = ".part"
+
+    def __init__(self, directory=default_staging_path, max_bytes=2 * 1024 * 1024 * 1024, catalog=None, workers=4, retries=1):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.catalog = catalog
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.pending = {} # path -> future of copies not finished yet
+        self.keep = set() # entries of the last prefetched piece
+        self.in_use = collections.Counter() # entry -> localized jobs printing it
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="staging")
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # Each source file gets its own folder, so the copy keeps its name
+    def entry(self, file):
+        return self.directory.joinpath(hashlib.sha1(str(file).encode("utf-8")).hexdigest()[:16])
+
+    # Returns the local copy of a file, copying it if there is none or the source has changed
+    def stage(self, file):
+        file = pathlib.Path(file)
+        source_stat = os.stat(file)
+        entry = self.entry(file)
+        target = entry.joinpath(file.name)
+        try:
+            target_stat = os.stat(target)
+            if target_stat.st_size == source_stat.st_size and target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                os.utime(entry) # Most recently used
+                return target
+        except FileNotFoundError:
+            pass
+        for attempt in range(self.retries + 1):
+            try:
+                self.copy(file, source_stat, target)
+                break
+            except OSError as error:
+                if attempt == self.retries:
+                    raise
+                logging.warning("{}, copying again".format(error))
+        with self.lock:
+            keep = self.keep.union(self.entry(path) for path in self.pending).union(self.in_use)
+        self.evict(keep)
+        return target
+
+    def copy(self, file, source_stat, target):
+        with tracer.span("stage", file=file.name) as span:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            partial = target.with_name(target.name + self.suffix)
+            digest = hashlib.sha256()
+            with open(file, "rb") as source, open(partial, "wb") as output:
+                for block in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(block)
+                    output.write(block)
+                size = output.tell()
+            span.count = size
+            expected = None if self.catalog is None else self.catalog.get_file_hash(file, source_stat.st_size, source_stat.st_mtime)
+            second_read = expected is None and self.catalog is not None and size == source_stat.st_size
+            if second_read:
+                expected = self.read_hash(file)
+            if size != source_stat.st_size or (expected is not None and expected != digest.hexdigest()):
+                partial.unlink()
+                raise OSError("Copy of {} does not match {}".format(file, "a second read" if second_read else "the catalog"))
+            if second_read:
+                self.catalog.put_file_hash(file, source_stat.st_size, source_stat.st_mtime, expected)
+            os.utime(partial, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            os.replace(partial, target)
+
+    @staticmethod
+    def read_hash(file):
+        digest = hashlib.sha256()
+        with open(file, "rb") as stream:
+            for block in iter(lambda: stream.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    # Returns {file: future of the local copy}, reusing copies already on their way
+    def submit(self, files):
+        futures = {}
+        with self.lock:
+            for file in files:
+                future = self.pending.get(str(file))
+                if future is None:
+                    future = self.pool.submit(self.stage, file)
+                    self.pending[str(file)] = future
+                    future.add_done_callback(lambda future, key=str(file): self.finished(key, future))
+                futures[file] = future
+        return futures
+
+    def finished(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    # Starts copying the files of a selected piece in the background
+    def prefetch(self, files):
+        files = list(files)
+        self.keep = set(self.entry(file) for file in files)
+        return self.submit(files)
+
+    # Returns the (file, copies) to print, with the local copies of the files. A file that
+    # can not be copied is printed from the library. The copies are not evicted until the
+    # same files are given to release after printing.
+    def localize(self, files):
+        files = list(files)
+        with self.lock:
+            self.in_use.update(self.entry(file) for file, copies in files)
+        try:
+            futures = self.submit(file for file, copies in files)
+            local = []
+            for file, copies in files:
+                try:
+                    local.append((futures[file].result(), copies))
+                except (OSError, concurrent.futures.CancelledError) as error:
+                    logging.warning("Could not stage {}, printing from the library: {}".format(file, error))
+                    local.append((file, copies))
+        except BaseException:
+            self.release(files)
+            raise
+        return local
+
+    def release(self, files):
+        with self.lock:
+            self.in_use.subtract(self.entry(file) for file, copies in files)
+            for entry in [entry for entry, count in self.in_use.items() if count <= 0]:
+                del self.in_use[entry]
+
+    # Removes the least recently used entries until the cache fits, except those in keep
+    def evict(self, keep=()):
+        with self.evict_lock:
+            entries = []
+            total = 0
+            for entry in self.directory.iterdir():
+                try:
+                    size = sum(item.stat().st_size for item in entry.iterdir())
+                    mtime = entry.stat().st_mtime
+                except OSError: # A copy finished or was evicted while counting
+                    continue
+                total += size
+                if entry not in keep:
+                    entries.append((mtime, size, entry))
+            entries.sort()
+            while total > self.max_bytes and len(entries) > 0:
+                mtime, size, entry = entries.pop(0)
+                logging.debug("Evicting {} from the staging cache".format(entry.name))
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+# Sends raw printer language data to a Windows printer, bypassing the driver
+def send_raw_to_printer(file, copies, printer=None):
+    win32print = optional_import("win32print")
+    if win32print is None:
+        raise RuntimeError("Printing to a Windows printer needs win32print (pywin32)")
+    printer = printer if printer is not None else win32print.GetDefaultPrinter()
+    with open(file, "rb") as stream:
+        data = stream.read()
+    handle = win32print.OpenPrinter(printer)
+    try:
+        win32print.StartDocPrinter(handle, 1, (pathlib.Path(file).name, None, "RAW"))
+        try:
+            for copy in range(copies):
+                win32print.StartPagePrinter(handle)
+                win32print.WritePrinter(handle, data)
+                win32print.EndPagePrinter(handle)
+        finally:
+            win32print.EndDocPrinter(handle)
+    finally:
+        win32print.ClosePrinter(handle)
+
+# Sends a list of (file, copies) through a single Ghostscript session.
+# Every distinct file is sent once and the copies are made with NumCopies. Without an
+# output directory the job goes to the Windows printer through mswinpr2, with one each file
+# is written as a PDF to that directory instead, which works on any platform.
+# With a PrintReadyCache the files are instead converted to cache_device (a printer language
+# such as PCL XL or PostScript) once, and the cached output is sent to the printer as raw data.
+class GhostscriptPrinter():
+    def __init__(self, printer=None, output_directory=None, paper_size="a4", module=None, cache=None, cache_device="pxlmono", duplex=False):
+        self.printer = printer
+        self.output_directory = output_directory
+        self.paper_size = paper_size
+        self.module = module
+        self.cache = cache
+        self.cache_device = cache_device
+        self.duplex = duplex
+
+    def args(self, files):
+        args = [
+            "-dPrinted", "-dNOPAUSE", "-dNOPROMPT",
+            "-q",
+            "-sPAPERSIZE#{}".format(self.paper_size),
+        ]
+        if self.output_directory is None:
+            printer = self.printer
+            if printer is None:
+                win32print = optional_import("win32print")
+                if win32print is None:
+                    raise RuntimeError("No printer given and win32print (pywin32) is not installed to find the default one")
+                printer = win32print.GetDefaultPrinter()
+            args.append("-sDEVICE#mswinpr2")
+            args.append("-sOutputFile#%printer%{}".format(printer))
+        else:
+            pathlib.Path(self.output_directory).mkdir(parents=True, exist_ok=True)
+            args.append("-sDEVICE#pdfwrite")
+            args.append("-sOutputFile#{}".format(self.output_path(files[0][0], files[0][1])))
+        return args + GhostscriptSession.permit_read(file for file, copies in files)
 
-    def print_one(self, files):
+    def output_path(self, file, copies):
+        return pathlib.Path(self.output_directory).joinpath("{} x{}.pdf".format(pathlib.Path(file).stem, copies))
+
+    def postscript(self, file, copies):
+        settings = "/NumCopies {} /Collate true".format(copies)
+        if self.duplex:
+            settings += " /Duplex true /Tumble false"
+        return "<< {} >> setpagedevice {} run".format(settings, GhostscriptSession.ps_path(file))
+
+    # Copies of the same file are added together
+    @staticmethod
+    def distinct(jobs):
+        copies_by_file = {}
+        for file, copies in jobs:
+            if copies > 0:
+                copies_by_file[file] = copies_by_file.get(file, 0) + copies
+        return list(copies_by_file.items())
+
+    def conversion_args(self):
+        args = ["-dPrinted", "-dNOPAUSE", "-dNOPROMPT", "-q", "-sPAPERSIZE#{}".format(self.paper_size), "-sDEVICE#{}".format(self.cache_device)]
+        if self.duplex:
+            args.append("-dDuplex")
+        return args
+
+    # Returns the print-ready file for each file, converting only those not in the cache.
+    # With evict the cache is trimmed afterwards, keeping the files just returned.
+    def convert(self, files, evict=True):
+        args = self.conversion_args()
+        converted = {}
+        missing = []
         for file in files:
-            print("print_one: {}".format(file))
-            
-            args = [
-                "-dPrinted", "-dBATCH", "-dNOPAUSE", "-dNOPROMPT"
-                "-q",
-                "-dNumCopies#1",
-                "-sDEVICE#mswinpr2",
-                "-sOutputFile#%printer%{}".format(win32print.GetDefaultPrinter()),
-                "{}".format(pathlib.PureWindowsPath(file))
-            ]
-
-            encoding = locale.getpreferredencoding()
-            args = [a.encode(encoding) for a in args]
-            logging.debug(args)
-            ghostscript.Ghostscript(*args)
-            
-            #os.system("'C:\\Program Files\\gs\\gs10.03.0\\bin\\gswin64.exe' -dPrinted -dBATCH -dNOPAUSE -dNOPROMPT-q -dNumCopies#1 -sDEVICE#mswinpr2 -sOutputFile#%printer%Kontor 'C:\\Notearkivtest\\Bandology\\Bandology kornett 1.pdf'")
-            #import subprocess
-            #subprocess.run("C:\\Program Files\\gs\\gs10.03.0\\bin\\gswin64.exe -dPrinted -dBATCH -dNOPAUSE -dNOPROMPT-q -dNumCopies#1 -sDEVICE#mswinpr2 -sOutputFile#%printer%{} \"{}\"".format(win32print.GetDefaultPrinter(), file))
-
-    def print_all(self):
-        for instrument in range(len(instruments)):
-            if ( len(self.files_by_instrument[instrument]) > 0 ) and ( instruments[instrument][0] in besetning ) and (besetning[instruments[instrument][0]] > 0):
-                logging.debug("WOLOLO!")
-                for file in self.files_by_instrument[instrument]:
-                    logging.debug("Print: {}".format(file))
-                    numberOfCopies = math.ceil(besetning[instruments[instrument][0]] / len(self.files_by_instrument[instrument]))
-                    for copy in range(0,numberOfCopies):
-                        args = [
-                            "-dPrinted", "-dBATCH", "-dNOPAUSE", "-dNOPROMPT"
-                            "-q",
-                            "-sPAPERSIZE#a4",
-                            "-sDEVICE#mswinpr2",
-                            "-sOutputFile#%printer%{}".format(win32print.GetDefaultPrinter()),
-                            "{}".format(pathlib.PureWindowsPath(file))
-                        ]
-
-                        encoding = locale.getpreferredencoding()
-                        args = [a.encode(encoding) for a in args]
-                        logging.debug(args)
-                        #with ghostscript.Ghostscript(*args) as g:
-                        ghostscript.Ghostscript(*args)
-                        ghostscript.cleanup()
-
-    def print_all_pdf(self):
-        for instrument in range(len(instruments)):
-            if ( len(self.files_by_instrument[instrument]) > 0 ) and ( instruments[instrument][0] in besetning ) and (besetning[instruments[instrument][0]] > 0):
-                logging.debug("WOLOLO!")
-                for file in self.files_by_instrument[instrument]:
-                    logging.debug("Print: {}".format(file))
-                    args = [
-                        "-dPrinted", "-dBATCH", "-dNOPAUSE", "-dNOPROMPT"
-                        "-q",
-                        "-dNumCopies#{}".format(math.ceil(besetning[instruments[instrument][0]] / len(self.files_by_instrument[instrument]) )),
-                        "-sDEVICE#pdfwrite",
-                        "-sOutputFile#combined.pdf",
-                        "{}".format(pathlib.PureWindowsPath(file))
-                    ]
-
-                    encoding = locale.getpreferredencoding()
-                    args = [a.encode(encoding) for a in args]
-                    logging.debug(args)
-                    #with ghostscript.Ghostscript(*args) as g:
-                    ghostscript.Ghostscript(*args)
-                    ghostscript.cleanup()
-    
-    def print_all_object(self):
-        for instrument in range(len(instruments)):
-            if ( len(self.files_by_instrument[instrument]) > 0 ) and ( instruments[instrument][0] in besetning ) and (besetning[instruments[instrument][0]] > 0):
-                logging.debug("WOLOLO!")
-                for file in self.files_by_instrument[instrument]:
-                    logging.debug("Print: {}".format(file))
-                    args = [
-                        "-dPrinted", "-dBATCH", "-dNOPAUSE", "-dNOPROMPT"
-                        "-q",
-                        "-dNumCopies#{}".format(math.ceil(besetning[instruments[instrument][0]] / len(self.files_by_instrument[instrument]) )),
-                        "-sDEVICE#mswinpr2",
-                        "-sOutputFile#%printer%{}".format(win32print.GetDefaultPrinter()),
-                        "{}".format(pathlib.PureWindowsPath(file))
-                    ]
-
-                    encoding = locale.getpreferredencoding()
-                    args = [a.encode(encoding) for a in args]
-                    logging.debug(args)
-                    #with ghostscript.Ghostscript(*args) as g:
-                    ghostscript.Ghostscript(*args)
-                    ghostscript.cleanup()
+            key = self.cache.key(file, args)
+            path = self.cache.get(key)
+            if path is not None:
+                converted[file] = path
+            else:
+                missing.append((file, key))
+        logging.info("Print cache: {} hits, {} to convert".format(len(converted), len(missing)))
+        # -dSAFER does not allow changing the OutputFile within a session, so each file is
+        # converted in a session of its own. With the cache this is only done once per file.
+        for file, key in missing:
+            output = self.cache.directory.joinpath(key + ".tmp")
+            session_args = args + ["-sOutputFile#{}".format(output)] + GhostscriptSession.permit_read([file])
+            with GhostscriptSession(session_args, self.module) as session:
+                with tracer.span("convert", file=pathlib.Path(file).name):
+                    session.run("{} run".format(GhostscriptSession.ps_path(file)))
+            converted[file] = self.cache.put(key, output)
+        if len(missing) > 0 and evict:
+            self.cache.evict(keep=converted.values())
+        return converted
 
+    def print_files(self, jobs):
+        report = PrintReport()
+        files = self.distinct(jobs)
+        if len(files) == 0:
+            return report
+        started = time.perf_counter()
+        if self.cache is not None:
+            converted = self.convert([file for file, copies in files])
+            for file, copies in files:
+                file_started = time.perf_counter()
+                with tracer.span("print", file=pathlib.Path(file).name, copies=copies, cached=True):
+                    if self.output_directory is not None:
+                        pathlib.Path(self.output_directory).mkdir(parents=True, exist_ok=True)
+                        shutil.copyfile(converted[file], self.output_path(file, copies).with_suffix(PrintReadyCache.suffix))
+                    else:
+                        send_raw_to_printer(converted[file], copies, self.printer)
+                report.add(file, copies, time.perf_counter() - file_started)
+        else:
+            # -dSAFER does not allow changing the OutputFile within a session, so printing to
+            # a directory needs a session per file
+            sessions = [files] if self.output_directory is None else [[job] for job in files]
+            for session_files in sessions:
+                with GhostscriptSession(self.args(session_files), self.module) as session:
+                    for file, copies in session_files:
+                        file_started = time.perf_counter()
+                        with tracer.span("print", file=pathlib.Path(file).name, copies=copies):
+                            session.run(self.postscript(file, copies))
+                        report.add(file, copies, time.perf_counter() - file_started)
+        report.seconds = time.perf_counter() - started
+        logging.info("Print job done\n{}".format(report.summary()))
+        return report
 
-if __name__ == "__main__":
+# Writes all the parts of a job into one PDF.
+# With pypdf each distinct file is read once, and every copy gets its own page objects that
+# point at the same content streams and resources, so the output grows with the number of
+# distinct pages rather than with the number of copies. Without pypdf the parts are run
+# through a single Ghostscript pdfwrite session, which has to render every copy.
+def merge_pdf(jobs, output, module=None):
+    started = time.perf_counter()
+    files = GhostscriptPrinter.distinct(jobs)
+    with tracer.span("merge", output=pathlib.Path(output).name) as span:
+        span.count = len(files)
+        pathlib.Path(output).parent.mkdir(parents=True, exist_ok=True)
+        pages = 0
+        pypdf = optional_import("pypdf")
+        if pypdf is not None and module is None:
+            writer = pypdf.PdfWriter()
+            for file, copies in files:
+                reader = pypdf.PdfReader(str(file))
+                for copy in range(copies):
+                    for page in reader.pages:
+                        writer.add_page(page)
+                        pages += 1
+            with open(output, "wb") as stream:
+                writer.write(stream)
+        else:
+            args = ["-dNOPAUSE", "-dNOPROMPT", "-q", "-sDEVICE#pdfwrite", "-sOutputFile#{}".format(output)]
+            args += GhostscriptSession.permit_read(file for file, copies in files)
+            with GhostscriptSession(args, module) as session:
+                for file, copies in files:
+                    for copy in range(copies):
+                        session.run("{} run".format(GhostscriptSession.ps_path(file)))
+    logging.info("Merged {} files into {} ({} pages) in {:.2f} s".format(len(files), output, pages, time.perf_counter() - started))
+    return output
+
+# Page count, size of the first page in points and file size in bytes of a PDF
+class PdfInfo():
+    __slots__ = ("pages", "width", "height", "size")
+
+    def __init__(self, pages, width, height, size):
+        self.pages = pages
+        self.width = width
+        self.height = height
+        self.size = size
+
+    def __repr__(self):
+        return "PdfInfo({} pages, {:.0f}x{:.0f} pt, {} bytes)".format(self.pages, self.width, self.height, self.size)
+
+pdf_page_pattern = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+pdf_count_pattern = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+pdf_mediabox_pattern = re.compile(rb"/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]")
+
+# Reads the PdfInfo of one file, None if it can not be read. Runs in the worker processes
+# of PdfInfoReader. Without pypdf the page objects are counted in the raw file, which finds
+# nothing in compressed object streams, so the largest /Count of a page tree is used as well.
+def read_pdf_info(file):
+    try:
+        size = os.stat(file).st_size
+        pypdf = optional_import("pypdf")
+        if pypdf is not None:
+            reader = pypdf.PdfReader(str(file))
+            pages = len(reader.pages)
+            if pages == 0:
+                return PdfInfo(0, 0.0, 0.0, size)
+            box = reader.pages[0].mediabox
+            return PdfInfo(pages, float(box.width), float(box.height), size)
+        with open(file, "rb") as stream:
+            data = stream.read()
+        counts = [int(a or b) for a, b in pdf_count_pattern.findall(data)]
+        pages = max([len(pdf_page_pattern.findall(data))] + counts)
+        box = pdf_mediabox_pattern.search(data)
+        width, height = (0.0, 0.0) if box is None else (abs(float(box[3]) - float(box[1])), abs(float(box[4]) - float(box[2])))
+        return PdfInfo(pages, width, height, size)
+    except Exception as error:
+        logging.warning("Could not read {}: {}".format(file, error))
+        return None
+
+# Reads PdfInfo for many files at once on a process pool.
+# Results are kept by path, size and modification time, in memory and in the catalog if
+# there is one, so a file is only opened again when it has changed.
+class PdfInfoReader():
+    min_parallel = 8 # fewer files than this are read in this process
+
+    def __init__(self, catalog=None, workers=None):
+        self.catalog = catalog
+        self.workers = workers
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+    # Returns {file: PdfInfo} for the files that could be read
+    def read(self, files):
+        infos = {}
+        missing = []
+        with tracer.span("pdf info") as span:
+            for file in files:
+                try:
+                    file_stat = os.stat(file)
+                except OSError as error:
+                    logging.warning("Could not read {}: {}".format(file, error))
+                    continue
+                key = (str(file), file_stat.st_size, file_stat.st_mtime)
+                info = self.cache.get(key)
+                if info is None and self.catalog is not None:
+                    info = self.catalog.get_pdf_info(*key)
+                    if info is not None:
+                        self.cache[key] = info
+                if info is not None:
+                    infos[file] = info
+                else:
+                    missing.append((file, key))
+            span.count = len(missing)
+            if len(missing) == 0:
+                return infos
+            paths = [file for file, key in missing]
+            if len(missing) < self.min_parallel:
+                results = [read_pdf_info(file) for file in paths]
+            else:
+                chunk = max(1, len(paths) // (4 * (self.workers or os.cpu_count() or 1)))
+                results = self.executor().map(read_pdf_info, paths, chunksize=chunk)
+            read = []
+            for (file, key), info in zip(missing, results):
+                if info is None:
+                    continue
+                infos[file] = info
+                self.cache[key] = info
+                read.append((key[0], key[2], info))
+            if self.catalog is not None and len(read) > 0:
+                self.catalog.put_pdf_info(read)
+        logging.info("Read page counts of {} files, {} from the cache".format(len(infos), len(infos) - len(read)))
+        return infos
+
+# Expected pages, sheets and printing time of a list of (file, copies).
+# Files without a PdfInfo are counted in unknown and left out of the totals. With an Imposer
+# the sheets are counted as they will be printed after imposition.
+class PrintEstimate():
+    def __init__(self, jobs, infos, pages_per_minute=30, pages_per_sheet=1, seconds_per_file=2.0, imposer=None):
+        self.files = 0
+        self.pages = 0
+        self.sheets = 0
+        self.unknown = 0
+        for file, copies in jobs:
+            info = infos.get(file)
+            if info is None:
+                self.unknown += 1
+                continue
+            self.files += 1
+            self.pages += info.pages * copies
+            self.sheets += math.ceil(info.pages / pages_per_sheet) * copies
+        if imposer is not None:
+            self.sheets = imposer.plan(jobs, infos).sheets_after()
+        self.seconds = 60 * self.pages / pages_per_minute + seconds_per_file * self.files
+
+    def __str__(self):
+        text = "{} ark, ca. {}:{:02d} min".format(self.sheets, int(self.seconds // 60), int(self.seconds % 60))
+        if self.unknown > 0:
+            text += " ({} filer ukjent)".format(self.unknown)
+        return text
+
+# Orders (file, copies) by the number of pages to print, so short parts come out before
+# long scores. Files without a PdfInfo go last.
+def shortest_first(jobs, infos):
+    def pages(job):
+        info = infos.get(job[0])
+        return math.inf if info is None else info.pages * job[1]
+    return sorted(jobs, key=pages)
+
+default_imposition_path = pathlib.Path.home().joinpath(".sheetMusicPrinter", "imposed")
+
+# How each file of a job is imposed, with the sheets printed before and after
+class ImpositionPlan():
+    def __init__(self):
+        self.entries = [] # (file, copies, layout, sheets before, sheets after)
+
+    def add(self, file, copies, layout, before, after):
+        self.entries.append((file, copies, layout, before, after))
+
+    def sheets_before(self):
+        return sum(entry[3] for entry in self.entries)
+
+    def sheets_after(self):
+        return sum(entry[4] for entry in self.entries)
+
+    def summary(self):
+        two_up = sum(1 for entry in self.entries if entry[2] == "2-up")
+        padded = sum(1 for entry in self.entries if entry[2] == "padded")
+        before = self.sheets_before()
+        after = self.sheets_after()
+        return "{} sheets instead of {}, {} saved ({} files 2-up, {} padded for duplex)".format(after, before, before - after, two_up, padded)
+
+# Puts short parts 2-up on landscape A4 and pads parts for duplex printing, as new PDFs in
+# directory, before a job goes to the print backend.
+# Parts of at most max_pages pages that are A5-sized or smaller are placed side by side: a
+# one-page part twice, so half as many sheets are printed and then cut, longer parts two pages
+# to a sheet. For duplex printing, parts with an odd number of pages get a blank last page so
+# every copy starts on its own sheet. Imposed files are kept by the hash of the original and
+# reused. This is a pure PDF transform with pypdf, without it files are printed as they are.
+class Imposer():
+    sheet = (842.0, 595.0) # landscape A4 in points
+    tolerance = 1.03 # pages up to 3 % larger than half a sheet still count as A5
+
+    def __init__(self, directory=default_imposition_path, two_up=True, duplex=False, max_pages=2):
+        self.directory = pathlib.Path(directory)
+        self.two_up = two_up
+        self.duplex = duplex
+        self.max_pages = max_pages
+        if optional_import("pypdf") is None:
+            logging.warning("pypdf is not installed, files are printed without imposition")
+
+    def fits_half_sheet(self, info):
+        return info.width <= self.sheet[0] / 2 * self.tolerance and info.height <= self.sheet[1] * self.tolerance
+
+    # Returns "2-up", "padded" or None for a file with the given PdfInfo
+    def layout(self, info):
+        if info is None or info.pages == 0 or optional_import("pypdf") is None:
+            return None
+        if self.two_up and info.pages <= self.max_pages and self.fits_half_sheet(info):
+            return "2-up"
+        if self.duplex and info.pages % 2 == 1:
+            return "padded"
+        return None
+
+    # Copies to print and sheets per copy of a file after imposition
+    def copies_and_sheets(self, info, copies, layout):
+        sides = info.pages
+        if layout == "2-up":
+            sides = math.ceil(info.pages / 2)
+            if info.pages == 1:
+                copies = math.ceil(copies / 2)
+        elif layout == "padded":
+            sides = info.pages + 1
+        return copies, math.ceil(sides / 2) if self.duplex else sides
+
+    # Works out the layout and the sheets of every (file, copies), printing one sided without
+    # imposition as the baseline
+    def plan(self, jobs, infos):
+        plan = ImpositionPlan()
+        for file, copies in jobs:
+            info = infos.get(file)
+            if info is None:
+                plan.add(file, copies, None, 0, 0)
+                continue
+            layout = self.layout(info)
+            printed, sheets = self.copies_and_sheets(info, copies, layout)
+            plan.add(file, copies, layout, info.pages * copies, printed * sheets)
+        return plan
+
+    def output_path(self, file, layout):
+        key = hashlib.sha256()
+        with open(file, "rb") as stream:
+            for block in iter(lambda: stream.read(1024 * 1024), b""):
+                key.update(block)
+        key.update("{} {} {}".format(layout, self.sheet, self.duplex).encode("utf-8"))
+        return self.directory.joinpath(key.hexdigest()[:16], "{} {}.pdf".format(pathlib.Path(file).stem, layout))
+
+    def write(self, file, layout, output):
+        pypdf = optional_import("pypdf")
+        reader = pypdf.PdfReader(str(file))
+        writer = pypdf.PdfWriter()
+        if layout == "2-up":
+            pages = list(reader.pages) if len(reader.pages) > 1 else [reader.pages[0]] * 2
+            slot_width = self.sheet[0] / 2
+            for first in range(0, len(pages), 2):
+                sheet = writer.add_blank_page(*self.sheet)
+                for slot, page in enumerate(pages[first:first + 2]):
+                    box = page.mediabox
+                    scale = min(1.0, slot_width / float(box.width), self.sheet[1] / float(box.height))
+                    x = slot * slot_width + (slot_width - float(box.width) * scale) / 2 - float(box.left) * scale
+                    y = (self.sheet[1] - float(box.height) * scale) / 2 - float(box.bottom) * scale
+                    sheet.merge_transformed_page(page, pypdf.Transformation().scale(scale).translate(x, y))
+            if self.duplex and len(writer.pages) % 2 == 1:
+                writer.add_blank_page(*self.sheet)
+        else:
+            for page in reader.pages:
+                writer.add_page(page)
+            last = reader.pages[-1].mediabox
+            writer.add_blank_page(float(last.width), float(last.height))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        temporary = output.with_suffix(".tmp")
+        with open(temporary, "wb") as stream:
+            writer.write(stream)
+        os.replace(temporary, output)
+
+    # Returns the (file, copies) to print instead of jobs, and the plan with the sheets saved
+    def impose(self, jobs, infos):
+        plan = self.plan(jobs, infos)
+        imposed = []
+        for file, copies, layout, before, after in plan.entries:
+            if layout is None:
+                imposed.append((file, copies))
+                continue
+            with tracer.span("impose", file=pathlib.Path(file).name, layout=layout):
+                output = self.output_path(file, layout)
+                if not output.exists():
+                    self.write(file, layout, output)
+            printed, sheets = self.copies_and_sheets(infos[file], copies, layout)
+            imposed.append((output, printed))
+        return imposed, plan
+
+# A print job in the spool queue: a named list of (file, copies)
+class PrintJob():
+    def __init__(self, name, files):
+        self.name = str(name)
+        self.files = GhostscriptPrinter.distinct(files)
+        self.estimate = None
+        self.status = "queued" # queued, printing, done, failed or cancelled
+        self.attempts = 0
+        self.report = None
+        self.error = None
+        self.cancelled = threading.Event()
+
+    def __str__(self):
+        return "{} ({} files, {})".format(self.name, len(self.files), self.status)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    # Estimates the job from the page counts and puts the shortest files first
+    def schedule(self, infos, pages_per_minute=30, imposer=None):
+        self.files = shortest_first(self.files, infos)
+        self.estimate = PrintEstimate(self.files, infos, pages_per_minute, imposer=imposer)
+        return self
+
+# Interface of the print backends used by PrintSpooler.
+# print_files gets a list of distinct (file, copies) and returns a PrintReport. It runs on
+# a spooler thread; max_workers limits how many jobs the backend may print at once.
+class PrintBackend():
+    name = "backend"
+    max_workers = 1
+
+    def print_files(self, files):
+        raise NotImplementedError
+
+# Prints through Ghostscript, by default on the Windows printer with mswinpr2.
+# There is only one Ghostscript interpreter per process, so one job at a time.
+class GhostscriptBackend(PrintBackend):
+    name = "ghostscript"
+    max_workers = 1
+
+    def __init__(self, printer=None):
+        self.printer = printer if printer is not None else GhostscriptPrinter()
+
+    def print_files(self, files):
+        return self.printer.print_files(files)
+
+# Prints PDF files directly with the CUPS lp command
+class CupsBackend(PrintBackend):
+    name = "cups"
+    max_workers = 2
+
+    def __init__(self, printer=None, paper_size="A4", command="lp", duplex=False):
+        self.printer = printer
+        self.paper_size = paper_size
+        self.command = command
+        self.duplex = duplex
+
+    def args(self, file, copies):
+        args = [self.command, "-n", str(copies), "-o", "collate=true", "-o", "media={}".format(self.paper_size)]
+        if self.duplex:
+            args += ["-o", "sides=two-sided-long-edge"]
+        if self.printer is not None:
+            args += ["-d", self.printer]
+        return args + ["--", str(file)]
+
+    def print_files(self, files):
+        report = PrintReport()
+        started = time.perf_counter()
+        for file, copies in files:
+            file_started = time.perf_counter()
+            with tracer.span("print", file=pathlib.Path(file).name, copies=copies):
+                subprocess.run(self.args(file, copies), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            report.add(file, copies, time.perf_counter() - file_started)
+        report.seconds = time.perf_counter() - started
+        return report
+
+# Stand-in printer that copies each file into a directory, named with the number of copies.
+# Needs neither a printer nor Ghostscript, so print jobs can be checked on any machine.
+class DirectoryBackend(PrintBackend):
+    name = "directory"
+    max_workers = 4
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+
+    def print_files(self, files):
+        report = PrintReport()
+        started = time.perf_counter()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for file, copies in files:
+            file_started = time.perf_counter()
+            file = pathlib.Path(file)
+            with tracer.span("print", file=file.name, copies=copies):
+                shutil.copyfile(file, self.directory.joinpath("{} x{}{}".format(file.stem, copies, file.suffix)))
+            report.add(file, copies, time.perf_counter() - file_started)
+        report.seconds = time.perf_counter() - started
+        return report
+
+# Imposes each job with an Imposer, then prints it with another backend
+class ImposingBackend(PrintBackend):
+    def __init__(self, backend, imposer, pdf_info=None):
+        self.backend = backend
+        self.imposer = imposer
+        self.pdf_info = pdf_info if pdf_info is not None else PdfInfoReader()
+        self.name = backend.name
+        self.max_workers = backend.max_workers
+
+    def print_files(self, files):
+        infos = self.pdf_info.read(file for file, copies in files)
+        imposed, plan = self.imposer.impose(files, infos)
+        logging.info("Imposed: {}".format(plan.summary()))
+        report = self.backend.print_files(imposed)
+        report.imposition = plan
+        return report
+
+# Prints the local copies of the files from a StagingCache with another backend
+class StagingBackend(PrintBackend):
+    def __init__(self, backend, staging):
+        self.backend = backend
+        self.staging = staging
+        self.name = backend.name
+        self.max_workers = backend.max_workers
+
+    def print_files(self, files):
+        files = list(files)
+        local = self.staging.localize(files)
+        try:
+            return self.backend.print_files(local)
+        finally:
+            self.staging.release(files)
+
+# Bounded queue of print jobs handled by worker threads.
+# Failed jobs are tried again up to retries times, a cancelled job is skipped if it has not
+# started yet. Submitting to a full queue raises queue.Full instead of blocking the caller,
+# unless the caller asks to block, as the batch mode does.
+# With order "shortest" the queued job with the smallest estimated printing time is printed
+# next, so a long score does not hold up the parts queued after it. Jobs without an estimate,
+# and all jobs with order "queued", are printed in the order they were submitted.
+class PrintSpooler():
+    orders = ("queued", "shortest")
+
+    def __init__(self, backend, workers=1, max_queued=50, retries=2, retry_delay=5.0, order="queued"):
+        if order not in self.orders:
+            raise ValueError("Unknown print order {}".format(order))
+        self.backend = backend
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.order = order
+        self.jobs = queue.PriorityQueue(maxsize=max_queued) # (priority, sequence, job)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.finished = collections.deque() # completion times of recent jobs
+        self.completed = 0
+        self.failed = 0
+        self.stopping = threading.Event()
+        self.threads = []
+        for i in range(max(1, min(workers, backend.max_workers))):
+            thread = threading.Thread(target=self.work, name="spooler-{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def priority(self, job):
+        if self.order == "shortest" and job.estimate is not None:
+            return job.estimate.seconds
+        return 0
+
+    # Raises queue.Full when max_queued jobs are waiting, unless block waits for room
+    def submit(self, job, block=False):
+        self.jobs.put((self.priority(job), next(self.sequence), job), block=block)
+        logging.info("Queued print job {}{}".format(job, "" if job.estimate is None else ", " + str(job.estimate)))
+        return job
+
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    # Jobs queued or printing
+    def pending(self):
+        return self.jobs.unfinished_tasks
+
+    # Completed jobs per minute over the last window seconds
+    def jobs_per_minute(self, window=300):
+        now = time.monotonic()
+        with self.lock:
+            while len(self.finished) > 0 and now - self.finished[0] > window:
+                self.finished.popleft()
+            return 60 * len(self.finished) / window
+
+    # Blocks until every queued job is done
+    def join(self):
+        self.jobs.join()
+
+    # Stops the workers after the jobs they are printing, dropping the queued ones
+    def close(self):
+        self.stopping.set()
+        for thread in self.threads:
+            try:
+                self.jobs.put_nowait((-math.inf, next(self.sequence), None))
+            except queue.Full:
+                break # the workers are busy and stop at the next job they take
+
+    def work(self):
+        while True:
+            priority, sequence, job = self.jobs.get()
+            try:
+                if job is None or self.stopping.is_set():
+                    return
+                self.run(job)
+            finally:
+                self.jobs.task_done()
+
+    def run(self, job):
+        while not job.is_cancelled():
+            job.status = "printing"
+            job.attempts += 1
+            try:
+                job.report = self.backend.print_files(job.files)
+                job.status = "done"
+                logging.info("Printed {}\n{}".format(job, job.report.summary()))
+                with self.lock:
+                    self.completed += 1
+                    self.finished.append(time.monotonic())
+                return
+            except Exception as error:
+                job.error = error
+                if job.attempts > self.retries:
+                    job.status = "failed"
+                    logging.exception("Printing {} failed".format(job))
+                    with self.lock:
+                        self.failed += 1
+                    return
+                logging.warning("Printing {} failed, retrying: {}".format(job, error))
+                job.cancelled.wait(self.retry_delay)
+        job.status = "cancelled"
+        logging.info("Cancelled {}".format(job))
+
+# Trigram index over the titles in the library for searching as you type.
+# Titles are normalized (case, æ/ø/å and accents folded) so "oyvind" finds "Øyvind".
+# Every word of a query must occur somewhere in the title. Words of three letters or more
+# are looked up in the index, shorter ones are checked against all titles.
+class SearchIndex():
+    gram_size = 3
+    folding = str.maketrans({"æ": "ae", "ø": "o", "å": "a", "ß": "ss"})
+
+    def __init__(self, titles=()):
+        self.next_id = 0
+        self.ids = {} # title -> id, ids increase in the order titles were added
+        self.titles = {} # id -> title
+        self.normalized = {} # id -> normalized title
+        self.grams = {} # trigram -> set of ids
+        for title in titles:
+            self.add(title)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, title):
+        return title in self.ids
+
+    @classmethod
+    def normalize(cls, text):
+        text = str(text).casefold().translate(cls.folding)
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+        return " ".join(text.split())
+
+    @classmethod
+    def trigrams(cls, text):
+        return set(text[i:i + cls.gram_size] for i in range(len(text) - cls.gram_size + 1))
+
+    def add(self, title):
+        if title in self.ids:
+            return
+        title_id = self.next_id
+        self.next_id += 1
+        normalized = self.normalize(title)
+        self.ids[title] = title_id
+        self.titles[title_id] = title
+        self.normalized[title_id] = normalized
+        for gram in self.trigrams(normalized):
+            self.grams.setdefault(gram, set()).add(title_id)
+
+    def remove(self, title):
+        title_id = self.ids.pop(title, None)
+        if title_id is None:
+            return
+        del self.titles[title_id]
+        for gram in self.trigrams(self.normalized.pop(title_id)):
+            ids = self.grams[gram]
+            ids.discard(title_id)
+            if len(ids) == 0:
+                del self.grams[gram]
+
+    # Returns the matching titles in the order they were added
+    def search(self, query):
+        words = self.normalize(query).split()
+        if len(words) == 0:
+            return list(self.titles.values())
+        candidates = None
+        for word in words:
+            if len(word) < self.gram_size:
+                continue
+            for gram in sorted(self.trigrams(word), key=lambda gram: len(self.grams.get(gram, ()))):
+                ids = self.grams.get(gram)
+                if ids is None:
+                    return []
+                candidates = set(ids) if candidates is None else candidates.intersection(ids)
+                if len(candidates) == 0:
+                    return []
+        # The trigrams of a word can all occur in a title without the word itself, so check
+        normalized = self.normalized
+        if candidates is None:
+            matches = [title_id for title_id, text in normalized.items() if words[0] in text]
+            words = words[1:]
+        else:
+            matches = sorted(candidates)
+        for word in words:
+            matches = [title_id for title_id in matches if word in normalized[title_id]]
+        return [self.titles[title_id] for title_id in matches]
+
+    def matches(self, title, query):
+        normalized = self.normalize(title)
+        return all(word in normalized for word in self.normalize(query).split())
+
+# Finds the library folder for a piece name given on the command line.
+# An exact or case-insensitive match wins, otherwise the first search result is used.
+def resolve_piece(name, pieces, search_index=None):
+    if name in pieces:
+        return name
+    for piece in pieces:
+        if piece.casefold() == name.casefold():
+            return piece
+    search_index = search_index if search_index is not None else SearchIndex(pieces)
+    matches = search_index.search(name)
+    if len(matches) > 0:
+        if len(matches) > 1:
+            logging.warning("\"{}\" matches {} pieces, using \"{}\"".format(name, len(matches), matches[0]))
+        return matches[0]
+    return None
+
+# Runs in a worker process: reads and classifies the files of a piece and plans the copies.
+# With a print cache the files are also converted, so printing only has to send them. With an
+# Imposer they are imposed first and the imposed files are converted, as they will be printed.
+# Returns the piece, the jobs, the seconds taken and the converted files. The workers share
+# the cache, so it is trimmed once by the caller when all pieces are prepared.
+def prepare_piece(library_path, piece, ensemble_name, registry_path=None, print_cache=None, print_cache_size=None, print_cache_device=None, imposer=None):
+    started = time.perf_counter()
+    converted = {}
+    if registry_path is not None and str(registry_path) != str(registry.path):
+        load_registry(registry_path)
+    files = []
+    for item in pathlib.Path(library_path).joinpath(piece).glob('*pdf'):
+        if item.is_file():
+            files.append(item)
+    files.sort(key=lambda item: item.name.lower())
+    classifications = instrument_classifier.match_files(files)
+    log_uncertain(instrument_classifier.uncertain(files, classifications))
+    jobs = plan_copies(instrument_classifier.sort_classified(files, classifications), registry.ensemble(ensemble_name), piece)
+    if print_cache is not None:
+        files = jobs
+        if imposer is not None:
+            files, plan = imposer.impose(jobs, {file: read_pdf_info(file) for file, copies in GhostscriptPrinter.distinct(jobs)})
+        cache = PrintReadyCache(print_cache, print_cache_size)
+        printer = GhostscriptPrinter(cache=cache, cache_device=print_cache_device, duplex=imposer is not None and imposer.duplex)
+        converted = printer.convert([file for file, copies in GhostscriptPrinter.distinct(files)], evict=False)
+    return piece, jobs, time.perf_counter() - started, list(converted.values())
+
+# Prepares all pieces of a program in parallel, then prints them in program order
+def run_batch(path, piece_names, ensemble_name, spooler, catalog=None, merge_directory=None, workers=None, dry_run=False, print_cache=None, print_cache_device=None, pages_per_minute=30, imposer=None, staging=None):
+    if catalog is not None:
+        pieces = catalog.read_pieces()
+    else:
+        pieces = [str(item.name) for item in path.iterdir() if item.is_dir()]
+    search_index = SearchIndex(pieces)
+    program = []
+    for name in piece_names:
+        piece = resolve_piece(name, pieces, search_index)
+        if piece is None:
+            logging.error("No piece matching \"{}\"".format(name))
+        else:
+            program.append(piece)
+
+    cache_args = (None, None, None) if print_cache is None else (str(print_cache.directory), print_cache.max_bytes, print_cache_device)
+    started = time.perf_counter()
+    prepared = {}
+    converted = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(prepare_piece, str(path), piece, ensemble_name, str(registry.path), *cache_args, imposer) for piece in program]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                piece, jobs, seconds, piece_converted = future.result()
+            except Exception:
+                logging.exception("Preparing a piece failed")
+                continue
+            prepared[piece] = jobs
+            converted += piece_converted
+            if tracer.enabled: # Prepared in another process, recorded as if it just finished here
+                tracer.record("prepare", time.perf_counter() - seconds, seconds, len(jobs), {"piece": piece})
+            print("{:>7.2f} s  {:>3} files  {} copies  {}".format(seconds, len(jobs), sum(copies for file, copies in jobs), piece))
+    print("Prepared {} pieces in {:.2f} s".format(len(prepared), time.perf_counter() - started))
+    if print_cache is not None:
+        print_cache.evict(keep=converted)
+    if staging is not None and not dry_run and merge_directory is None:
+        # Copied in the background while the first jobs print
+        staging.prefetch(file for piece in program if piece in prepared for file, copies in prepared[piece])
+
+    reader = PdfInfoReader(catalog, workers)
+    try:
+        infos = reader.read(set(file for jobs in prepared.values() for file, copies in jobs))
+    finally:
+        reader.close()
+    print("Estimated {}".format(PrintEstimate([job for jobs in prepared.values() for job in jobs], infos, pages_per_minute, imposer=imposer)))
+
+    for piece in program:
+        if piece not in prepared:
+            continue
+        job = PrintJob(piece, prepared[piece]).schedule(infos, pages_per_minute, imposer)
+        if dry_run:
+            print("{}: {}".format(piece, job.estimate))
+            if imposer is not None:
+                print(imposer.plan(job.files, infos).summary())
+            for file, copies in job.files:
+                print("{:>3} x  {}".format(copies, file))
+        elif merge_directory is not None:
+            merge_pdf(prepared[piece], pathlib.Path(merge_directory).joinpath("{}.pdf".format(piece)))
+        else:
+            spooler.submit(job, block=True)
+    spooler.join()
+    print("Printed {} jobs, {} failed".format(spooler.completed, spooler.failed))
+    return prepared
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Tool for printing full or partial sets of sheet music")
     parser.add_argument("--directory", dest="directory", required=False,
                         help="The directory containing the sheet music library")
-    parser.add_argument("-d", "--debug", help="logging.info debug info", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    parser.add_argument("--instruments", dest="instruments", default=str(default_registry_path),
+                        help="JSON file with the instruments, their aliases and the ensembles")
+    parser.add_argument("--catalog", dest="catalog", required=False, default=str(default_catalog_path),
+                        help="SQLite file caching the library contents between runs")
+    parser.add_argument("--no-catalog", dest="catalog", action="store_const", const=None,
+                        help="Always read the library folders directly")
+    parser.add_argument("--print-to-directory", dest="print_directory", required=False,
+                        help="Write print jobs as PDF files to this directory instead of the printer")
+    parser.add_argument("--backend", dest="backend", default="ghostscript", choices=["ghostscript", "cups", "directory"],
+                        help="How to print: Ghostscript (mswinpr2 on Windows), CUPS lp, or copying the files to --print-to-directory")
+    parser.add_argument("--printer", dest="printer", required=False,
+                        help="Printer name, the default printer is used if not given")
+    parser.add_argument("--print-retries", dest="print_retries", type=int, default=2,
+                        help="How many times a failed print job is tried again")
+    parser.add_argument("--print-cache", dest="print_cache", nargs="?", const=str(default_print_cache_path), default=None,
+                        help="Convert files to printer language once and keep them in this directory")
+    parser.add_argument("--print-cache-size", dest="print_cache_size", type=int, default=1024,
+                        help="Size limit of the print cache in MB")
+    parser.add_argument("--print-cache-device", dest="print_cache_device", default="pxlmono",
+                        help="Ghostscript device used to convert files for the print cache, e.g. pxlmono, pxlcolor or ps2write")
+    parser.add_argument("--staging", dest="staging", nargs="?", const=str(default_staging_path), default=None,
+                        help="Copy the files of a selected piece to this local directory before printing them")
+    parser.add_argument("--staging-size", dest="staging_size", type=int, default=2048,
+                        help="Size limit of the staging cache in MB")
+    parser.add_argument("--two-up", dest="two_up", action="store_true",
+                        help="Print parts of one or two A5 pages 2-up on A4 (needs pypdf)")
+    parser.add_argument("--duplex", dest="duplex", action="store_true",
+                        help="Print on both sides, parts with an odd number of pages get a blank last page (needs pypdf)")
+    parser.add_argument("--pages-per-minute", dest="pages_per_minute", type=float, default=30,
+                        help="Speed of the printer, used to estimate how long a job takes")
+    parser.add_argument("--print-order", dest="print_order", choices=PrintSpooler.orders, default=None,
+                        help="Print queued jobs in the order they were queued, or the shortest first. "
+                             "The default is shortest in the GUI and queued (program order) for batch")
+    parser.add_argument("--watch", dest="watch", type=float, nargs="?", const=5.0, default=None,
+                        help="Keep the library view up to date, checking for changes every WATCH seconds (default 5)")
+    parser.add_argument("--watch-poll", dest="use_inotify", action="store_false",
+                        help="Only poll for changes, do not use inotify")
+    parser.add_argument("-d", "--debug", help="Log debug info and time the stages of reading and printing", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    parser.add_argument("--trace", dest="trace", required=False,
+                        help="Time the stages of reading and printing and write them as Chrome trace JSON to this file on exit")
+    subparsers = parser.add_subparsers(dest="command", help="Without a command the GUI is started")
+    batch_parser = subparsers.add_parser("batch", help="Print a list of pieces without the GUI")
+    batch_parser.add_argument("pieces", nargs="+", help="Names of the pieces to print, in program order")
+    batch_parser.add_argument("--ensemble", dest="ensemble", default=None,
+                              help="Which besetning to print for, as named in the instrument file")
+    batch_parser.add_argument("--merge-to-directory", dest="merge_directory", required=False,
+                              help="Write one merged PDF per piece to this directory instead of printing")
+    batch_parser.add_argument("--workers", dest="workers", type=int, default=None,
+                              help="Number of processes preparing pieces")
+    batch_parser.add_argument("--dry-run", dest="dry_run", action="store_true",
+                              help="Only list the files and copies that would be printed")
 
-    args = parser.parse_args()
-    #logging.basicConfig(level=args.loglevel)
-    logging.basicConfig(level="DEBUG")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel, force=True)
+    tracer.enabled = args.loglevel == logging.DEBUG or args.trace is not None
 
     if args.directory is not None:
         path = pathlib.Path(args.directory)
@@ -509,5 +2335,56 @@ if __name__ == "__main__":
 
     logging.info("Notearkiv path: {}".format(path))
 
-    printer = sheetMusicPrinter(path)
-    printer.run()
\ No newline at end of file
+    load_registry(args.instruments)
+    if args.command == "batch" and args.ensemble is not None and args.ensemble not in registry.ensembles:
+        parser.error("Unknown ensemble {}, choose from {}".format(args.ensemble, ", ".join(sorted(registry.ensembles))))
+
+    catalog = None
+    if args.catalog is not None:
+        catalog = LibraryCatalog(path, args.catalog)
+
+    print_cache = None
+    if args.print_cache is not None:
+        print_cache = PrintReadyCache(args.print_cache, args.print_cache_size * 1024 * 1024)
+
+    if args.backend == "cups":
+        backend = CupsBackend(args.printer, duplex=args.duplex)
+    elif args.backend == "directory":
+        if args.print_directory is None:
+            parser.error("--backend directory needs --print-to-directory")
+        backend = DirectoryBackend(args.print_directory)
+    else:
+        backend = GhostscriptBackend(GhostscriptPrinter(printer=args.printer, output_directory=args.print_directory, cache=print_cache, cache_device=args.print_cache_device, duplex=args.duplex))
+    imposer = None
+    if args.two_up or args.duplex:
+        imposer = Imposer(two_up=args.two_up, duplex=args.duplex)
+        backend = ImposingBackend(backend, imposer, PdfInfoReader(catalog))
+    staging = None
+    if args.staging is not None:
+        staging = StagingCache(args.staging, args.staging_size * 1024 * 1024, catalog)
+        backend = StagingBackend(backend, staging)
+    print_order = args.print_order
+    if print_order is None:
+        print_order = "queued" if args.command == "batch" else "shortest"
+    spooler = PrintSpooler(backend, workers=backend.max_workers, retries=args.print_retries, order=print_order)
+
+    if args.command == "batch":
+        run_batch(path, args.pieces, args.ensemble, spooler, catalog,
+                  merge_directory=args.merge_directory, workers=args.workers, dry_run=args.dry_run,
+                  print_cache=print_cache, print_cache_device=args.print_cache_device, pages_per_minute=args.pages_per_minute, imposer=imposer, staging=staging)
+    else:
+        import sheetMusicPrinterGui
+        printer = sheetMusicPrinterGui.sheetMusicPrinter(path, catalog, spooler, args.print_directory, args.pages_per_minute, args.watch, args.use_inotify, imposer, staging)
+        printer.run()
+    if staging is not None:
+        staging.close()
+
+    if tracer.enabled:
+        logging.debug("Stage timings\n{}".format(tracer.summary()))
+    if args.trace is not None:
+        tracer.write_chrome_trace(args.trace)
+
+if __name__ == "__main__":
+    # Run as the sheetMusicPrinter module, so the GUI and the worker processes share its state
+    import sheetMusicPrinter
+    sheetMusicPrinter.main()
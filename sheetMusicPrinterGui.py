@@ -0,0 +1,544 @@
+# The Tkinter GUI of sheetMusicPrinter, imported only when the GUI is started
+import os
+import pathlib
+import logging
+import queue
+import threading
+import time
+import concurrent.futures
+import tkinter as tk
+from tkinter import messagebox
+
+import sheetMusicPrinter as core
+
+
+# The instrument, amount and print widgets of the besetning grid.
+# Rows are created the first time they are needed and then reused for every selection: the
+# values are written into the existing widgets where they differ from what the widget holds,
+# which includes amounts typed by the user, and unused rows are hidden. Each button calls
+# pressed(row) with its own row number, bound once, so rebinding a row only changes the
+# Python side and no Tcl commands pile up.
+class InstrumentRowPool():
+    def __init__(self, master, pressed, first_row=2, first_column=2):
+        self.master = master
+        self.pressed = pressed
+        self.first_row = first_row
+        self.first_column = first_column
+        self.rows = [] # (name entry, amount entry, button)
+        self.buttons_shown = [] # whether each row's print button is shown
+        self.targets = [] # what each row's button prints
+        self.visible = 0
+
+    def create_row(self):
+        row = len(self.rows)
+        name_entry = tk.Entry(self.master)
+        name_entry.grid(row=self.first_row + row, column=self.first_column)
+        amount_entry = tk.Entry(self.master)
+        amount_entry.grid(row=self.first_row + row, column=self.first_column + 1)
+        button = tk.Button(self.master, text="Print", command=lambda row=row: self.pressed(row))
+        button.grid(row=self.first_row + row, column=self.first_column + 2)
+        # New rows start hidden, grid() without options brings them back in place
+        for widget in (name_entry, amount_entry, button):
+            widget.grid_remove()
+        self.rows.append((name_entry, amount_entry, button))
+        self.buttons_shown.append(False)
+        self.targets.append(None)
+
+    @staticmethod
+    def set_text(entry, text):
+        entry.delete(0, tk.END)
+        entry.insert(tk.END, text)
+
+    # rows is a list of (name, amount, target), a target of None hides the print button
+    def show(self, rows):
+        while len(self.rows) < len(rows):
+            self.create_row()
+        for row, (name, amount, target) in enumerate(rows):
+            name_entry, amount_entry, button = self.rows[row]
+            button_shown = self.buttons_shown[row]
+            if row >= self.visible:
+                name_entry.grid()
+                amount_entry.grid()
+                button_shown = False
+            if str(name) != name_entry.get():
+                self.set_text(name_entry, name)
+            if str(amount) != amount_entry.get():
+                self.set_text(amount_entry, amount)
+            if target is not None and not button_shown:
+                button.grid()
+            elif target is None and button_shown:
+                button.grid_remove()
+            self.buttons_shown[row] = target is not None
+            self.targets[row] = target
+        for row in range(len(rows), self.visible):
+            for widget in self.rows[row]:
+                widget.grid_remove()
+            self.targets[row] = None
+        self.visible = len(rows)
+
+    def amount(self, row):
+        return self.rows[row][1].get()
+
+# A unit of work running on a background thread. Results are tagged with the job so the
+# GUI can drop results from a job that has been replaced by a newer one.
+class BackgroundJob():
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+class sheetMusicPrinter(tk.Tk):
+    result_poll_interval = 50 # ms
+    result_batch_size = 200 # results per message sent from the workers
+    result_batch_interval = 0.1 # seconds before a partial batch is sent anyway
+    result_poll_budget = 0.01 # seconds spent moving results into the widgets per poll
+    job_stages = {"entries": "library read", "files": "file glob"} # trace stage of each kind of background job
+
+    def __init__(self, path, catalog=None, spooler=None, pdf_directory=None, pages_per_minute=30, watch_interval=None, use_inotify=True, imposer=None, staging=None):
+        tk.Tk.__init__(self)
+        self.library_path = path
+        self.catalog = catalog
+        self.spooler = spooler if spooler is not None else core.PrintSpooler(core.GhostscriptBackend())
+        self.pdf_directory = pdf_directory
+        self.pages_per_minute = pages_per_minute
+        self.imposer = imposer
+        self.staging = staging
+        self.pdf_info = core.PdfInfoReader(catalog)
+        self.pdf_infos = {}
+        self.workers = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="scanner")
+        self.results = queue.Queue()
+        self.library_job = None
+        self.selection_job = None
+        self.classifications = []
+        self.closing = False # waiting for the print queue before closing
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.num_search_results = len(core.registry.instruments)
+        self.ensemble = core.registry.ensemble()
+        self.besetning_instruments = self.ensemble.instruments()
+        self.title("Sheet Music Printer")
+        self.selected_search_result = "None"
+        self.libraryEntries = []
+        self.musicfiles = []
+        self.files_by_instrument = []
+        search_label = tk.Label(text="Søk")
+        search_label.grid(row=0, column=0)
+        self.search_index = core.SearchIndex()
+        self.search_var = tk.StringVar()
+        self.search_var.trace_add("write", self.search_changed)
+        search_entry = tk.Entry(textvariable=self.search_var)
+        search_entry.grid(row=1, column=0)
+        self.search_results_var = tk.Variable(value=self.libraryEntries)
+        self.search_results = tk.Listbox(self, listvariable=self.search_results_var, height=self.num_search_results, width=50)
+        self.search_results.grid(row=2, column=0, rowspan=len(core.registry.instruments))
+        self.search_results.bind('<<ListboxSelect>>', self.search_result_selected)
+        self.selected_search_result_label = tk.Label(text=self.selected_search_result)
+        self.selected_search_result_label.grid(row=0, column=1)
+        self.spooler_status = ""
+        self.spooler_label = tk.Label(text=self.spooler_status)
+        self.spooler_label.grid(row=0, column=3, columnspan=2)
+        self.ensemble_var = tk.StringVar(value=self.ensemble.name)
+        ensemble_menu = tk.OptionMenu(self, self.ensemble_var, *sorted(core.registry.ensembles), command=self.ensemble_selected)
+        ensemble_menu.grid(row=0, column=2)
+        self.musicfiles_var = tk.Variable(value=self.musicfiles)
+        self.musicfiles_box = tk.Listbox(self, listvariable=self.musicfiles_var, height=self.num_search_results, width=50)
+        self.musicfiles_box.grid(row=2, column=1, rowspan=len(core.registry.instruments))
+        self.estimate_label = tk.Label(text="")
+        self.estimate_label.grid(row=1, column=1)
+        instrument_label = tk.Label(text="Instrument")
+        instrument_label.grid(row=1, column=2)
+        instrument_label = tk.Label(text="Antall")
+        instrument_label.grid(row=1, column=3)
+        print_button = tk.Button(self, text="Print alle", command=self.print_all)
+        print_button.grid(row=1, column=4)
+        self.instrument_rows = InstrumentRowPool(self, self.print_row)
+        self.start_library_scan()
+        self.watch_job = BackgroundJob("watch")
+        self.watcher = None
+        if watch_interval is not None:
+            self.watcher = core.LibraryWatcher(path, self.library_changed, watch_interval, use_inotify).start()
+        self.after(self.result_poll_interval, self.poll_results)
+
+    def add_widgets_for_besetning(self):
+        logging.debug(self.files_by_instrument)
+
+        usingclass = True
+
+        rows = []
+        if usingclass == False:
+            for spec in core.registry.instruments:
+                players = self.ensemble.players.get(spec.name, 0)
+                if len(self.files_by_instrument[spec.index]) > 0:
+                    logging.debug("Files by instrument[{}]: {}".format(spec.index, self.files_by_instrument[spec.index]))
+                    rows.append((spec.name, players, (spec.index, None, None)))
+                elif players > 0:
+                    rows.append((spec.name, "IKKE FUNNET", None))
+        else:
+            # Rows by class
+            for instrument in self.besetning_instruments:
+                rows.append((str(instrument), instrument.amount, (core.registry.by_name[instrument.name].index, instrument.tuning, instrument.clef)))
+        with core.tracer.span("widget build", rows=len(rows)) as span:
+            self.instrument_rows.show(rows)
+            span.count = len(rows)
+
+    def run(self):
+        self.mainloop()
+
+    def update_spooler_status(self):
+        status = "Utskriftskø: {}, {:.1f} jobber/min".format(self.spooler.queue_depth(), self.spooler.jobs_per_minute())
+        if self.spooler.failed > 0:
+            status += ", {} feilet".format(self.spooler.failed)
+        if status != self.spooler_status:
+            self.spooler_status = status
+            self.spooler_label.config(text=status)
+
+    # Closing drops the queued print jobs and stops the ones printing, so while there are any
+    # the user chooses between waiting for them, closing anyway or not closing. Closing again
+    # while waiting closes at once.
+    def close(self):
+        pending = self.spooler.pending()
+        if pending > 0 and not self.closing:
+            wait = messagebox.askyesnocancel("Avslutt", "{} utskriftsjobber er ikke ferdige. Vente på dem før programmet avsluttes?".format(pending))
+            if wait is None:
+                return
+            if wait:
+                self.closing = True
+                self.wait_for_spooler()
+                return
+        if pending > 0:
+            logging.warning("Closing with {} print jobs not done".format(pending))
+        self.shut_down()
+
+    def wait_for_spooler(self):
+        if self.spooler.pending() > 0:
+            self.after(self.result_poll_interval, self.wait_for_spooler)
+        else:
+            self.shut_down()
+
+    def shut_down(self):
+        self.spooler.close()
+        self.pdf_info.close()
+        if self.watcher is not None:
+            self.watcher.stop()
+        for job in (self.library_job, self.selection_job):
+            if job is not None:
+                job.cancel()
+        self.workers.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
+
+    # Yields the names of the folders in the sheet music library
+    def iter_library_entries(self, path):
+        if self.catalog is not None:
+            yield from self.catalog.iter_pieces()
+        else:
+            for item in path.iterdir():
+                if item.is_dir():
+                    yield str(item.name)
+
+    # Yields (path, (instrument indices, confidence)) for the PDF files of a piece
+    def iter_files_for(self, piece):
+        if self.catalog is not None:
+            yield from self.catalog.iter_files(piece)
+        else:
+            path = self.library_path.joinpath(pathlib.Path(piece))
+            for item in path.glob('*pdf'):
+                if item.is_file():
+                    yield (item, core.instrument_classifier.match([item.name], piece)[0])
+
+    # Read folders in sheet music library and populate the list of entries
+    def readSheetMusicLibrary(self, path):
+        libraryEntries = []
+        try:
+            with core.tracer.span("library read", catalog=self.catalog is not None) as span:
+                libraryEntries = list(self.iter_library_entries(path))
+                span.count = len(libraryEntries)
+            self.libraryEntries = libraryEntries
+        except FileNotFoundError:
+            logging.error("Sheet Music Library Path not found")
+        return libraryEntries
+
+    # Filters the library list on every change of the search field
+    def search_changed(self, *args):
+        self.search_results_var.set(self.search_index.search(self.search_var.get()))
+
+    def search_result_selected(self, event):
+        selected_indices = self.search_results.curselection()
+        if len(selected_indices) == 0:
+            return
+        self.selected_search_result = self.search_results.get(selected_indices[0])
+        self.selected_search_result_label.config(text=self.selected_search_result)
+        logging.info("{}".format(self.selected_search_result))
+        self.start_selection_scan(self.selected_search_result)
+
+    def read_files_for_selected(self):
+        musicfiles = []
+        classifications = []
+        logging.info("Selected music path: {}".format(self.library_path.joinpath(pathlib.Path(self.selected_search_result))))
+        with core.tracer.span("file glob", piece=self.selected_search_result) as span:
+            for item, classification in self.iter_files_for(self.selected_search_result):
+                musicfiles.append(item)
+                classifications.append(classification)
+            span.count = len(musicfiles)
+        self.musicfiles = musicfiles
+        musicfiles_names = []
+        for file in musicfiles:
+            musicfiles_names.append(file.name)
+        
+        self.show_musicfiles(musicfiles_names)
+        self.identify_and_sort_files(classifications)
+        return musicfiles
+
+    def show_musicfiles(self, musicfiles_names):
+        with core.tracer.span("widget build", widget="files") as span:
+            self.musicfiles_var = tk.Variable(value=musicfiles_names)
+            self.musicfiles_box.config(listvariable=self.musicfiles_var)
+            span.count = len(musicfiles_names)
+
+    # Reads the library on a worker thread, the entries are added to the list as they arrive
+    def start_library_scan(self):
+        if self.library_job is not None:
+            self.library_job.cancel()
+        self.library_job = BackgroundJob(self.library_path)
+        self.libraryEntries = []
+        self.search_index = core.SearchIndex()
+        self.search_results.delete(0, tk.END)
+        self.workers.submit(self.run_job, self.library_job, "entries", self.iter_library_entries(self.library_path))
+
+    # Reads and classifies the files of a piece on a worker thread, cancelling any earlier selection
+    def start_selection_scan(self, piece):
+        if self.selection_job is not None:
+            self.selection_job.cancel()
+        self.selection_job = BackgroundJob(piece)
+        self.musicfiles = []
+        self.classifications = []
+        self.pdf_infos = {}
+        self.estimate_label.config(text="")
+        self.musicfiles_box.delete(0, tk.END)
+        logging.info("Selected music path: {}".format(self.library_path.joinpath(pathlib.Path(piece))))
+        if self.watcher is not None:
+            self.watcher.watch_piece(piece)
+        self.workers.submit(self.run_job, self.selection_job, "files", self.iter_files_for(piece))
+
+    # Runs on the watcher thread, the changes are applied by poll_results
+    def library_changed(self, kind, payload):
+        self.results.put((self.watch_job, kind, payload))
+
+    def add_entries(self, titles):
+        self.libraryEntries.extend(titles)
+        query = self.search_var.get()
+        for title in titles:
+            self.search_index.add(title)
+        shown = [title for title in titles if self.search_index.matches(title, query)]
+        if len(shown) > 0:
+            self.search_results.insert(tk.END, *shown)
+
+    def remove_entries(self, titles):
+        shown = self.search_results.get(0, tk.END)
+        for title in titles:
+            self.search_index.remove(title)
+            self.libraryEntries.remove(title)
+        for index in reversed([index for index, title in enumerate(shown) if title in titles]):
+            self.search_results.delete(index)
+
+    # Applies files added, changed or removed in the shown piece, then sorts them again
+    def update_files(self, kind, piece, items):
+        if piece != self.selected_search_result:
+            return
+        # The selection scan may still be running and see the same changes
+        if kind == "files_added":
+            for item, classification in items:
+                if item in self.musicfiles:
+                    continue
+                self.musicfiles.append(item)
+                self.classifications.append(classification)
+                self.musicfiles_box.insert(tk.END, item.name)
+        elif kind == "files_changed":
+            for item, classification in items:
+                if item in self.musicfiles:
+                    self.classifications[self.musicfiles.index(item)] = classification
+        else:
+            for item in items:
+                if item not in self.musicfiles:
+                    continue
+                index = self.musicfiles.index(item)
+                del self.musicfiles[index]
+                del self.classifications[index]
+                self.musicfiles_box.delete(index)
+        self.identify_and_sort_files(self.classifications)
+        self.workers.submit(self.read_page_counts, self.selection_job, list(self.musicfiles))
+        self.prefetch_files()
+
+    # Runs on a worker thread, sends the results to the GUI in batches
+    def run_job(self, job, kind, results):
+        batch = []
+        batch_started = time.monotonic()
+        count = 0
+        try:
+            with core.tracer.span(self.job_stages[kind], job=job.name) as span:
+                for result in results:
+                    if job.is_cancelled():
+                        logging.debug("Cancelled {}".format(job.name))
+                        results.close()
+                        return
+                    batch.append(result)
+                    count += 1
+                    span.count = count
+                    if len(batch) >= self.result_batch_size or time.monotonic() - batch_started > self.result_batch_interval:
+                        self.results.put((job, kind, batch))
+                        batch = []
+                        batch_started = time.monotonic()
+            if len(batch) > 0:
+                self.results.put((job, kind, batch))
+            self.results.put((job, kind + "_done", None))
+        except FileNotFoundError:
+            logging.error("Path not found: {}".format(job.name))
+        except Exception:
+            logging.exception("Scanning {} failed".format(job.name))
+
+    # Runs on a worker thread, reads the page counts of the selected piece for the estimate
+    def read_page_counts(self, job, files):
+        try:
+            infos = self.pdf_info.read(files)
+            self.results.put((job, "pdf_info", infos))
+        except Exception:
+            logging.exception("Reading page counts of {} failed".format(job.name))
+
+    def update_estimate(self):
+        if len(self.pdf_infos) > 0:
+            self.estimate_label.config(text=str(core.PrintEstimate(self.print_jobs(), self.pdf_infos, self.pages_per_minute, imposer=self.imposer)))
+
+    # Copies the files of the selected piece to the staging cache while the parts are chosen
+    def prefetch_files(self):
+        if self.staging is not None:
+            self.staging.prefetch(self.musicfiles)
+
+    # Runs on the GUI thread, moves finished results from the workers into the widgets
+    def poll_results(self):
+        deadline = time.monotonic() + self.result_poll_budget
+        try:
+            while time.monotonic() < deadline:
+                job, kind, payload = self.results.get_nowait()
+                if job.is_cancelled():
+                    continue
+                if kind == "entries":
+                    self.add_entries(payload)
+                elif kind == "entries_added":
+                    self.add_entries([title for title in payload if title not in self.search_index])
+                elif kind == "entries_removed":
+                    self.remove_entries([title for title in payload if title in self.search_index])
+                elif kind in ("files_added", "files_changed", "files_removed"):
+                    self.update_files(kind, *payload)
+                elif kind == "entries_done":
+                    logging.info("Library read: {} entries".format(len(self.libraryEntries)))
+                elif kind == "files":
+                    for item, classification in payload:
+                        self.musicfiles.append(item)
+                        self.classifications.append(classification)
+                        self.musicfiles_box.insert(tk.END, item.name)
+                elif kind == "files_done":
+                    self.identify_and_sort_files(self.classifications)
+                    self.workers.submit(self.read_page_counts, job, list(self.musicfiles))
+                    self.prefetch_files()
+                elif kind == "pdf_info":
+                    self.pdf_infos = payload
+                    self.update_estimate()
+        except queue.Empty:
+            pass
+        self.update_spooler_status()
+        self.after(self.result_poll_interval, self.poll_results)
+    
+    # Sorts the files by instrument. classifications are the (instrument indices, confidence)
+    # of the files from the worker or the catalog, the files are only classified here without them.
+    def identify_and_sort_files(self, classifications=None):
+        with core.tracer.span("classify", cached=classifications is not None) as span:
+            if classifications is None:
+                classifications = core.instrument_classifier.match_files(self.musicfiles)
+            files_by_instrument = core.instrument_classifier.sort_classified(self.musicfiles, classifications)
+            span.count = len(self.musicfiles)
+        self.files_by_instrument = files_by_instrument
+        self.add_widgets_for_besetning()
+        self.mark_uncertain(core.instrument_classifier.uncertain(self.musicfiles, classifications))
+        return files_by_instrument
+
+    # Colours the files the classifier is unsure about, which are not printed: red if no
+    # instrument was found, orange if one was only guessed
+    def mark_uncertain(self, uncertain):
+        core.log_uncertain(uncertain)
+        for file, indices, confidence in uncertain:
+            self.musicfiles_box.itemconfig(self.musicfiles.index(file), foreground="darkorange" if len(indices) > 0 else "red")
+
+    # Returns (file, Instrument) with the part, tuning and clef of every sorted file
+    def identify_voice(self):
+        voices = []
+        for i in range (0, len(core.registry.instruments)):
+            for file in self.files_by_instrument[i]:
+                voices.append((file, core.part_detector.instrument(file, self.selected_search_result, i)))
+        return voices
+
+    def print_one(self, files):
+        for file in files:
+            print("print_one: {}".format(file))
+        return self.submit_print_job(core.PrintJob(self.selected_search_result, [(file, 1) for file in files]))
+            
+            #os.system("'C:\\Program Files\\gs\\gs10.03.0\\bin\\gswin64.exe' -dPrinted -dBATCH -dNOPAUSE -dNOPROMPT-q -dNumCopies#1 -sDEVICE#mswinpr2 -sOutputFile#%printer%Kontor 'C:\\Notearkivtest\\Bandology\\Bandology kornett 1.pdf'")
+            #import subprocess
+            #subprocess.run("C:\\Program Files\\gs\\gs10.03.0\\bin\\gswin64.exe -dPrinted -dBATCH -dNOPAUSE -dNOPROMPT-q -dNumCopies#1 -sDEVICE#mswinpr2 -sOutputFile#%printer%{} \"{}\"".format(win32print.GetDefaultPrinter(), file))
+
+    # Prints the files of one row of the besetning grid, as many copies as its amount field says
+    def print_row(self, row):
+        target = self.instrument_rows.targets[row]
+        if target is None:
+            return None
+        index, tuning, clef = target
+        try:
+            amount = int(self.instrument_rows.amount(row))
+        except ValueError:
+            logging.error("Not a number: {}".format(self.instrument_rows.amount(row)))
+            return None
+        files = self.files_by_instrument[index]
+        name = core.registry.instruments[index].name
+        if name != "Score":
+            files = [file for file in files if not core.part_detector.is_score(file.name)]
+        if tuning is not None:
+            # Files in another tuning belong to another row, files without one fit every row
+            files = [file for file in files if core.part_detector.tuning(file.name) in (None, tuning)]
+        if clef is not None:
+            # Files in another clef belong to another row, files without one are in the instrument's usual clef
+            usual = core.registry.instruments[index].clef
+            files = [file for file in files if (core.part_detector.clef(file.name) or usual) in (None, clef)]
+        jobs = core.plan_part_copies(files, amount, self.selected_search_result, self.ensemble.parts.get(name))
+        return self.submit_print_job(core.PrintJob("{} {}".format(self.selected_search_result, name), jobs))
+
+    # Returns (file, copies) for every file needed by the besetning
+    def print_jobs(self):
+        return core.plan_copies(self.files_by_instrument, self.ensemble, self.selected_search_result)
+
+    def ensemble_selected(self, name):
+        self.ensemble = core.registry.ensemble(name)
+        self.besetning_instruments = self.ensemble.instruments()
+        if len(self.files_by_instrument) > 0:
+            self.add_widgets_for_besetning()
+            self.update_estimate()
+
+    def print_all(self):
+        return self.submit_print_job(core.PrintJob(self.selected_search_result, self.print_jobs()))
+
+    # Runs on the GUI thread, so the job is scheduled with the page counts already read by
+    # read_page_counts. Files without one yet are printed last and left out of the estimate.
+    def submit_print_job(self, job):
+        job.schedule(self.pdf_infos, self.pages_per_minute, self.imposer)
+        try:
+            return self.spooler.submit(job)
+        except queue.Full:
+            logging.error("Print queue is full, {} not queued".format(job))
+            return None
+
+    # Writes every copy needed by the besetning into one PDF named after the piece
+    def print_all_pdf(self):
+        directory = self.pdf_directory if self.pdf_directory is not None else os.getcwd()
+        output = pathlib.Path(directory).joinpath("{}.pdf".format(self.selected_search_result))
+        return core.merge_pdf(self.print_jobs(), output)
@@ -0,0 +1,377 @@
+import os
+import pathlib
+import queue
+import random
+import shutil
+import subprocess
+import threading
+import time
+import types
+
+import pytest
+
+import sheetMusicPrinter as core
+
+
+# The classification of the original identify_and_sort_files: every alias of every instrument
+# found in the name, unless a longer alias of any instrument is also found
+def nested_loop_buckets(instruments, names):
+    files_by_instrument = [[] for instrument in instruments]
+    for name in names:
+        for i in range(0, len(instruments)):
+            for instrument_variation in instruments[i]:
+                if instrument_variation.lower() in name.lower():
+                    unique = True
+                    for j in range(0, len(instruments)):
+                        for instrument_variation_check in instruments[j]:
+                            if len(instrument_variation_check) > len(instrument_variation) and instrument_variation_check.lower() in name.lower():
+                                unique = False
+                    if unique:
+                        files_by_instrument[i].append(name)
+    return files_by_instrument
+
+def alias_corpus(instruments, count=2000, seed=0):
+    rng = random.Random(seed)
+    aliases = [alias for aliases in instruments for alias in aliases]
+    names = ["{} {}.pdf".format(alias, part) for alias in aliases for part in ("", "1", "2")]
+    names += ["Bandology {} {}.pdf".format(rng.choice(aliases), rng.choice(aliases).upper()) for i in range(count)]
+    names += ["Bandology.pdf", "Solo.pdf", "Notes 1.pdf"]
+    return list(dict.fromkeys(names))
+
+def exact_buckets(classifier, names):
+    files_by_instrument = [[] for i in range(classifier.num_instruments)]
+    for name in names:
+        for i in classifier.classify_exact(name):
+            files_by_instrument[i].append(name)
+    return files_by_instrument
+
+def test_alias_table_buckets_like_the_nested_loop():
+    instruments = core.registry.alias_lists()
+    names = alias_corpus(instruments)
+    expected = [list(dict.fromkeys(bucket)) for bucket in nested_loop_buckets(instruments, names)]
+    assert exact_buckets(core.InstrumentClassifier(instruments), names) == expected
+
+# The nested loop added a file once for every alias of the same length that matched it, the
+# alias table adds it once per instrument
+def test_alias_table_adds_a_file_once_per_instrument():
+    instruments = core.registry.alias_lists()
+    trumpet = core.registry.spec("Trumpet").index
+    alto_sax = core.registry.spec("Alto Sax").index
+    names = ["Trompet, Kornett 1.pdf", "Alt sax (sax alt).pdf"]
+    old = nested_loop_buckets(instruments, names)
+    assert old[trumpet] == names[:1] * 2
+    assert old[alto_sax] == names[1:] * 2
+    new = exact_buckets(core.InstrumentClassifier(instruments), names)
+    assert new[trumpet] == names[:1]
+    assert new[alto_sax] == names[1:]
+
+def test_duplicated_alias_counts_once():
+    instruments = [["Tenor Sax", "Tenor Sax"], ["Sax"]]
+    names = ["Tenor Sax 1.pdf"]
+    assert nested_loop_buckets(instruments, names) == [names * 2, []]
+    assert exact_buckets(core.InstrumentClassifier(instruments), names) == [names, []]
+
+def piece_files(title, names):
+    folder = pathlib.Path("/library").joinpath(title)
+    return [folder.joinpath(name) for name in names]
+
+def test_weak_guesses_are_left_unclassified():
+    files = piece_files("Festmarsj", ["Festmarsj Solo.pdf", "Stortromme.pdf", "Xylofon.pdf"])
+    for file, (indices, confidence) in zip(files, core.instrument_classifier.match_files(files)):
+        assert indices == [], file.name
+
+def test_uncertain_files_get_no_copies():
+    files = piece_files("Festmarsj", ["Festmarsj Solo.pdf", "Piccolo.pdf", "Stortromme.pdf", "Xylofon.pdf", "Flauto.pdf",
+                                      "Trombone 1.pdf", "Trombone 2.pdf", "Trombone 3.pdf"])
+    ensemble = core.registry.ensemble("besetning_ohm")
+    jobs = dict((file.name, copies) for file, copies in core.plan_copies(core.instrument_classifier.sort_files(files), ensemble, "Festmarsj"))
+    assert jobs == {"Piccolo.pdf": 1, "Trombone 1.pdf": 3, "Trombone 2.pdf": 3, "Trombone 3.pdf": 2}
+    uncertain = [file.name for file, indices, confidence in core.instrument_classifier.uncertain(files)]
+    assert uncertain == ["Festmarsj Solo.pdf", "Stortromme.pdf", "Xylofon.pdf", "Flauto.pdf"]
+
+def test_confident_fuzzy_matches_are_sorted():
+    files = piece_files("Festmarsj", ["Kornet 2.pdf", "Flauto.pdf"])
+    files_by_instrument = core.instrument_classifier.sort_files(files)
+    trumpet = core.registry.spec("Trumpet").index
+    alto_flute = core.registry.spec("Alto flute").index
+    assert files_by_instrument[trumpet] == files[:1]
+    assert files_by_instrument[alto_flute] == []
+
+def test_abbreviations_are_sorted_confidently():
+    names = ["Trpt 2.pdf", "Klar..pdf", "Altsakso.pdf", "Euph.pdf", "Perc 1.pdf"]
+    expected = ["Trumpet", "Clarinet", "Alto Sax", "Euphonium", "Percussion"]
+    files = piece_files("Festmarsj", names)
+    for file, instrument, (indices, confidence) in zip(files, expected, core.instrument_classifier.match_files(files)):
+        assert indices == [core.registry.spec(instrument).index], file.name
+        assert core.instrument_classifier.is_confident(confidence), file.name
+    files_by_instrument = core.instrument_classifier.sort_files(files)
+    assert sorted(file for files in files_by_instrument for file in files) == sorted(files)
+
+def test_catalog_stores_confidence(tmp_path):
+    piece = tmp_path.joinpath("library", "Festmarsj")
+    piece.mkdir(parents=True)
+    for name in ["Piccolo.pdf", "Klar 2.pdf", "Xylofon.pdf"]:
+        piece.joinpath(name).write_bytes(b"%PDF-1.4\n")
+    catalog = core.LibraryCatalog(piece.parent, tmp_path.joinpath("catalog.sqlite"))
+    scanned = catalog.read_files("Festmarsj")
+    stored = catalog.read_files("Festmarsj")
+    catalog.close()
+    assert sorted(scanned) == stored
+    assert [(path.name, confidence == 1.0) for path, (indices, confidence) in stored] == [
+        ("Klar 2.pdf", False), ("Piccolo.pdf", True), ("Xylofon.pdf", False)]
+
+
+# Stands in for the ghostscript module, writing an empty output file for every file run
+class FakeGhostscript():
+    def __init__(self):
+        self.runs = 0
+        self.output = None
+
+    def Ghostscript(self, *args):
+        for arg in args:
+            if arg.startswith(b"-sOutputFile#"):
+                self.output = pathlib.Path(arg[len(b"-sOutputFile#"):].decode())
+        return self
+
+    def run_string(self, postscript):
+        self.runs += 1
+        self.output.write_bytes(b"")
+
+    def exit(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+def write_pdf(path, pages, width, height):
+    pypdf = pytest.importorskip("pypdf")
+    writer = pypdf.PdfWriter()
+    for page in range(pages):
+        writer.add_blank_page(width, height)
+    with open(path, "wb") as stream:
+        writer.write(stream)
+
+def test_prepared_conversions_are_used_when_printing_imposed(tmp_path, monkeypatch):
+    piece = tmp_path.joinpath("library", "Festmarsj")
+    piece.mkdir(parents=True)
+    write_pdf(piece.joinpath("Trumpet 1.pdf"), 1, 420, 595)
+    write_pdf(piece.joinpath("Trombone 1.pdf"), 3, 595, 842)
+    ghostscript = FakeGhostscript()
+    monkeypatch.setitem(core.optional_modules, "ghostscript", ghostscript)
+    imposer = core.Imposer(tmp_path.joinpath("imposed"), two_up=True, duplex=True)
+    cache_directory = tmp_path.joinpath("cache")
+    piece_name, jobs, seconds, converted = core.prepare_piece(piece.parent, "Festmarsj", "besetning_ohm", None, cache_directory, 10 ** 9, "pxlmono", imposer)
+    assert ghostscript.runs == 2
+    assert len(converted) == 2 and all(path.exists() for path in converted)
+
+    infos = {file: core.read_pdf_info(file) for file, copies in jobs}
+    imposed, plan = imposer.impose(jobs, infos)
+    printer = core.GhostscriptPrinter(printer="Test", cache=core.PrintReadyCache(cache_directory), duplex=True)
+    printer.convert([file for file, copies in imposed])
+    assert ghostscript.runs == 2
+
+def test_prepare_piece_leaves_eviction_to_the_caller(tmp_path, monkeypatch):
+    piece = tmp_path.joinpath("library", "Festmarsj")
+    piece.mkdir(parents=True)
+    write_pdf(piece.joinpath("Trumpet 1.pdf"), 1, 595, 842)
+    monkeypatch.setitem(core.optional_modules, "ghostscript", FakeGhostscript())
+    cache = core.PrintReadyCache(tmp_path.joinpath("cache"), 0)
+    other_piece = cache.directory.joinpath("other" + cache.suffix)
+    other_piece.write_bytes(b"converted by another worker")
+    core.prepare_piece(piece.parent, "Festmarsj", "besetning_ohm", None, cache.directory, 0, "pxlmono")
+    assert other_piece.exists()
+
+def test_evict_skips_entries_removed_meanwhile(tmp_path, monkeypatch):
+    cache = core.PrintReadyCache(tmp_path, 0)
+    entries = [tmp_path.joinpath(name + cache.suffix) for name in ("a", "gone", "b")]
+    for entry in entries[::2]:
+        entry.write_bytes(b"data")
+    monkeypatch.setattr(type(cache.directory), "glob", lambda directory, pattern: list(entries))
+    cache.evict()
+    assert not any(entry.exists() for entry in entries)
+
+# Prints nothing, holding every job until released
+class GatedBackend():
+    max_workers = 1
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.printed = []
+
+    def print_files(self, files):
+        self.released.wait(5)
+        self.printed.append(files)
+        return types.SimpleNamespace(summary=lambda: "")
+
+def test_batch_submit_waits_for_room_in_a_full_queue():
+    backend = GatedBackend()
+    spooler = core.PrintSpooler(backend, max_queued=1)
+    jobs = [core.PrintJob(str(i), [("{}.pdf".format(i), 1)]) for i in range(3)]
+    spooler.submit(jobs[0])
+    while spooler.queue_depth() > 0: # taken by the worker, which waits for the gate
+        time.sleep(0.01)
+    spooler.submit(jobs[1])
+    with pytest.raises(queue.Full):
+        spooler.submit(jobs[2])
+    submitter = threading.Thread(target=spooler.submit, args=(jobs[2], True))
+    submitter.start()
+    assert spooler.pending() == 2
+    backend.released.set()
+    submitter.join(5)
+    spooler.join()
+    assert spooler.pending() == 0
+    spooler.close()
+    assert backend.printed == [job.files for job in jobs]
+
+def test_every_part_is_printed_with_fewer_players_than_parts():
+    files = piece_files("Festmarsj", ["Trumpet 1.pdf", "Trumpet 2.pdf", "Trumpet 3.pdf"])
+    assert core.plan_part_copies(files, 2, "Festmarsj") == [(file, 1) for file in files]
+
+def test_parts_missing_from_the_distribution_are_printed():
+    files = piece_files("Festmarsj", ["Clarinet 1.pdf", "Clarinet 2.pdf", "Clarinet 3.pdf", "Clarinet 4.pdf"])
+    jobs = core.plan_part_copies(files, 6, "Festmarsj", {1: 2, 2: 2, 3: 2})
+    assert [copies for file, copies in jobs] == [2, 2, 2, 1]
+
+def test_the_narrowest_file_prints_each_part():
+    files = piece_files("Festmarsj", ["Trumpet 1-2.pdf", "Trumpet 1.pdf", "Trumpet 2.pdf"])
+    assert core.plan_part_copies(files, 4, "Festmarsj") == [(files[1], 2), (files[2], 2)]
+
+def test_parts_in_other_tunings_clefs_and_voices_are_all_printed():
+    files = piece_files("Festmarsj", ["Horn in F 1.pdf", "Horn in F 2.pdf", "Horn in Eb 1.pdf", "Horn in Eb 2.pdf",
+                                      "Trombone 1 BC.pdf", "Trombone 1 TC.pdf", "Trombone 2 BC.pdf", "Trombone 2 TC.pdf",
+                                      "Trumpet 1.pdf", "Trumpet 2.pdf", "Cornet 1.pdf", "Cornet 2.pdf"])
+    ensemble = core.registry.ensemble("besetning_ohm")
+    jobs = dict((file.name, copies) for file, copies in core.plan_copies(core.instrument_classifier.sort_files(files), ensemble, "Festmarsj"))
+    assert jobs == {"Horn in F 1.pdf": 1, "Horn in F 2.pdf": 1, "Horn in Eb 1.pdf": 1, "Horn in Eb 2.pdf": 1,
+                    "Trombone 1 BC.pdf": 2, "Trombone 1 TC.pdf": 2, "Trombone 2 BC.pdf": 2, "Trombone 2 TC.pdf": 2,
+                    "Trumpet 1.pdf": 2, "Trumpet 2.pdf": 2, "Cornet 1.pdf": 2, "Cornet 2.pdf": 2}
+
+def test_same_voice_in_other_spellings_is_one_part():
+    files = piece_files("Festmarsj", ["1st Trumpet.pdf", "Trumpet 1-2.pdf", "Trumpet II.pdf"])
+    assert core.plan_part_copies(files, 4, "Festmarsj") == [(files[0], 2), (files[2], 2)]
+
+
+gs_program = shutil.which("gs")
+needs_gs = pytest.mark.skipif(gs_program is None, reason="Ghostscript (gs) is not installed")
+
+# Stands in for the ghostscript module by running each session as a gs process, so the
+# arguments and PostScript are checked by a real Ghostscript with -dSAFER. Ghostscript may
+# always write to its temporary directory, which is moved out of the way of the outputs.
+class GhostscriptProcess():
+    def __init__(self, temporary):
+        temporary.mkdir(exist_ok=True)
+        self.environment = dict(os.environ, TMPDIR=str(temporary), TEMP=str(temporary))
+        self.sessions = 0
+
+    def Ghostscript(self, *args):
+        self.sessions += 1
+        return GhostscriptProcessSession(self.environment, [arg.decode() for arg in args[1:]])
+
+    def cleanup(self):
+        pass
+
+class GhostscriptProcessSession():
+    def __init__(self, environment, args):
+        self.environment = environment
+        self.args = args
+        self.postscript = []
+
+    def run_string(self, postscript):
+        self.postscript.append(postscript.decode())
+
+    def exit(self):
+        subprocess.run([gs_program, "-dBATCH"] + self.args + ["-c", " ".join(self.postscript)],
+                       check=True, env=self.environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+@needs_gs
+def test_print_to_directory_with_ghostscript(tmp_path):
+    files = [tmp_path.joinpath("Trumpet 1.pdf"), tmp_path.joinpath("Trumpet 2.pdf"), tmp_path.joinpath("Score.pdf")]
+    for file in files:
+        write_pdf(file, 2, 595, 842)
+    output = tmp_path.joinpath("printed")
+    printer = core.GhostscriptPrinter(output_directory=output, module=GhostscriptProcess(tmp_path.joinpath("gs-temp")))
+    printer.print_files([(files[0], 3), (files[1], 2), (files[2], 1)])
+    assert sorted(path.name for path in output.iterdir()) == ["Score x1.pdf", "Trumpet 1 x3.pdf", "Trumpet 2 x2.pdf"]
+
+@needs_gs
+def test_convert_several_files_with_ghostscript(tmp_path):
+    files = [tmp_path.joinpath("Trumpet 1.pdf"), tmp_path.joinpath("Trumpet 2.pdf")]
+    for file in files:
+        write_pdf(file, 1, 595, 842)
+    ghostscript = GhostscriptProcess(tmp_path.joinpath("gs-temp"))
+    printer = core.GhostscriptPrinter(cache=core.PrintReadyCache(tmp_path.joinpath("cache")), module=ghostscript, cache_device="ps2write")
+    converted = printer.convert(files)
+    assert sorted(converted) == files and all(path.stat().st_size > 0 for path in converted.values())
+    assert printer.convert(files) == converted
+    assert ghostscript.sessions == 2
+
+def watch_events(library, use_inotify):
+    events = queue.Queue()
+    watcher = core.LibraryWatcher(library, lambda kind, payload: events.put((kind, payload)), interval=0.05, use_inotify=use_inotify)
+    return watcher.start(), events
+
+def next_event(events, kind):
+    while True:
+        event_kind, payload = events.get(timeout=5)
+        if event_kind == kind:
+            return payload
+
+# select only takes sockets on Windows, so the watcher must not need it to poll
+@pytest.mark.parametrize("use_inotify", [False, True])
+def test_watcher_keeps_polling_without_select(tmp_path, monkeypatch, use_inotify):
+    def select(*args):
+        raise OSError("not a socket")
+    monkeypatch.setattr(core.select, "select", select)
+    tmp_path.joinpath("Festmarsj").mkdir()
+    watcher, events = watch_events(tmp_path, use_inotify)
+    try:
+        time.sleep(0.2)
+        tmp_path.joinpath("Bandology").mkdir()
+        assert next_event(events, "entries_added") == ["Bandology"]
+        watcher.watch_piece("Bandology")
+        time.sleep(0.2)
+        tmp_path.joinpath("Bandology", "Trumpet 1.pdf").write_bytes(b"%PDF-1.4\n")
+        piece, files = next_event(events, "files_added")
+        assert [path.name for path, classification in files] == ["Trumpet 1.pdf"]
+        assert watcher.thread.is_alive()
+    finally:
+        watcher.stop()
+
+def test_first_copy_stores_the_hash_only_when_two_reads_agree(tmp_path, monkeypatch):
+    piece = tmp_path.joinpath("library", "Festmarsj")
+    piece.mkdir(parents=True)
+    file = piece.joinpath("Piccolo.pdf")
+    file.write_bytes(b"%PDF-1.4\n" * 100)
+    catalog = core.LibraryCatalog(piece.parent, tmp_path.joinpath("catalog.sqlite"))
+    staging = core.StagingCache(tmp_path.joinpath("staging"), catalog=catalog, retries=1)
+    sha256 = core.StagingCache.read_hash(file)
+    reads = [sha256, "0" * 64] # the second read of the first copy disagrees, the retry's agrees
+    monkeypatch.setattr(core.StagingCache, "read_hash", staticmethod(lambda file: reads.pop()))
+    copy = staging.stage(file)
+    stat = file.stat()
+    stored = catalog.get_file_hash(file, stat.st_size, stat.st_mtime)
+    staging.close()
+    catalog.close()
+    assert reads == []
+    assert copy.read_bytes() == file.read_bytes()
+    assert stored == sha256
+
+def test_files_of_jobs_printing_are_not_evicted(tmp_path):
+    library = tmp_path.joinpath("library")
+    library.mkdir()
+    files = []
+    for name in ["a.pdf", "b.pdf", "c.pdf"]:
+        files.append(library.joinpath(name))
+        files[-1].write_bytes(b"x" * 100)
+    staging = core.StagingCache(tmp_path.joinpath("staging"), max_bytes=150)
+    printing = [(files[0], 1)]
+    local = staging.localize(printing)
+    for future in staging.prefetch(files[1:2]).values():
+        future.result()
+    assert local[0][0].exists()
+    staging.release(printing)
+    for future in staging.prefetch(files[2:]).values():
+        future.result()
+    staging.close()
+    assert not local[0][0].exists()
+    assert staging.in_use == {}
@@ -0,0 +1,169 @@
+import pathlib
+import queue
+import types
+
+import sheetMusicPrinter as core
+import sheetMusicPrinterGui as gui
+
+
+# Stand-in for the window with only what the worker methods use, so no display is needed
+def headless_window():
+    return types.SimpleNamespace(
+        results=queue.Queue(),
+        job_stages=gui.sheetMusicPrinter.job_stages,
+        result_batch_size=gui.sheetMusicPrinter.result_batch_size,
+        result_batch_interval=gui.sheetMusicPrinter.result_batch_interval)
+
+def drain(results):
+    messages = []
+    while not results.empty():
+        messages.append(results.get_nowait())
+    return messages
+
+def test_run_job_sends_results_with_tracing_disabled(monkeypatch):
+    monkeypatch.setattr(core.tracer, "enabled", False)
+    window = headless_window()
+    job = gui.BackgroundJob("library")
+    gui.sheetMusicPrinter.run_job(window, job, "entries", (name for name in ["A", "B", "C"]))
+    messages = drain(window.results)
+    assert [kind for _, kind, _ in messages] == ["entries", "entries_done"]
+    assert messages[0][2] == ["A", "B", "C"]
+
+def test_run_job_counts_results_with_tracing_enabled(monkeypatch):
+    monkeypatch.setattr(core, "tracer", core.Tracer(enabled=True))
+    window = headless_window()
+    job = gui.BackgroundJob("Bandology")
+    gui.sheetMusicPrinter.run_job(window, job, "files", (name for name in ["a.pdf", "b.pdf"]))
+    assert [kind for _, kind, _ in drain(window.results)] == ["files", "files_done"]
+    assert [(name, count) for name, started, seconds, count, args, thread in core.tracer.events] == [("file glob", 2)]
+
+def test_sorting_uses_the_classifications_given(monkeypatch):
+    def match_files(files):
+        raise AssertionError("classified again on the GUI thread")
+    monkeypatch.setattr(core.instrument_classifier, "match_files", match_files)
+    window = types.SimpleNamespace(musicfiles=[pathlib.Path("/library/Festmarsj/Piccolo.pdf")], marked=[])
+    window.add_widgets_for_besetning = lambda: None
+    window.mark_uncertain = window.marked.extend
+    piccolo = core.registry.spec("Piccolo").index
+    files_by_instrument = gui.sheetMusicPrinter.identify_and_sort_files(window, [([piccolo], 1.0)])
+    assert files_by_instrument[piccolo] == window.musicfiles
+    assert window.marked == []
+
+class FakeWidget():
+    def __init__(self, master=None, **options):
+        self.text = ""
+        self.writes = 0
+
+    def grid(self, **options):
+        pass
+
+    def grid_remove(self):
+        pass
+
+    def get(self):
+        return self.text
+
+    def delete(self, first, last=None):
+        self.text = ""
+
+    def insert(self, index, text):
+        self.text += str(text)
+        self.writes += 1
+
+def test_row_pool_resets_amounts_typed_by_the_user(monkeypatch):
+    monkeypatch.setattr(gui.tk, "Entry", FakeWidget)
+    monkeypatch.setattr(gui.tk, "Button", FakeWidget)
+    pool = gui.InstrumentRowPool(None, lambda row: None)
+    pool.show([("Trumpet", 8, (14, None, None))])
+    name_entry, amount_entry, button = pool.rows[0]
+    amount_entry.delete(0)
+    amount_entry.insert(0, "2")
+    assert pool.amount(0) == "2"
+    pool.show([("Trumpet", 8, (14, None, None))])
+    assert pool.amount(0) == "8"
+    writes = (name_entry.writes, amount_entry.writes)
+    pool.show([("Trumpet", 8, (14, None, None))])
+    assert (name_entry.writes, amount_entry.writes) == writes
+
+def test_print_jobs_are_scheduled_without_reading_files(monkeypatch):
+    def read(files):
+        raise AssertionError("read page counts on the GUI thread")
+    files = [pathlib.Path("/library/Festmarsj/Score.pdf"), pathlib.Path("/library/Festmarsj/Trumpet 1.pdf")]
+    submitted = []
+    window = types.SimpleNamespace(pdf_info=types.SimpleNamespace(read=read), pages_per_minute=30, imposer=None,
+                                   pdf_infos={files[0]: core.PdfInfo(12, 595, 842, 1000), files[1]: core.PdfInfo(1, 595, 842, 100)},
+                                   spooler=types.SimpleNamespace(submit=submitted.append))
+    job = core.PrintJob("Festmarsj", [(file, 1) for file in files])
+    gui.sheetMusicPrinter.submit_print_job(window, job)
+    assert submitted == [job]
+    assert job.files == [(files[1], 1), (files[0], 1)]
+    assert job.estimate.pages == 13
+
+class FakeRowPool():
+    def __init__(self):
+        self.targets = []
+        self.amounts = []
+
+    def show(self, rows):
+        self.amounts = [amount for name, amount, target in rows]
+        self.targets = [target for name, amount, target in rows]
+
+    def amount(self, row):
+        return str(self.amounts[row])
+
+def test_trombone_rows_print_the_parts_in_their_clef():
+    ensemble = core.registry.ensemble("besetning_ohm")
+    trombone = core.registry.spec("Trombone").index
+    files_by_instrument = [[] for spec in core.registry.instruments]
+    files_by_instrument[trombone] = [pathlib.Path("/library/Festmarsj").joinpath(name) for name in
+                                     ["Trombone 1.pdf", "Trombone 2.pdf", "Trombone 1 TC.pdf", "Trombone 2 TC.pdf"]]
+    submitted = []
+    window = types.SimpleNamespace(files_by_instrument=files_by_instrument, besetning_instruments=ensemble.instruments(),
+                                   instrument_rows=FakeRowPool(), selected_search_result="Festmarsj", ensemble=ensemble,
+                                   submit_print_job=submitted.append)
+    gui.sheetMusicPrinter.add_widgets_for_besetning(window)
+    rows = [row for row, target in enumerate(window.instrument_rows.targets) if target[0] == trombone]
+    assert [window.instrument_rows.targets[row][2] for row in rows] == ["BC", "TC"]
+    for row in rows:
+        gui.sheetMusicPrinter.print_row(window, row)
+    bass_clef, treble_clef = [sorted(file.name for file, copies in job.files) for job in submitted]
+    assert bass_clef == ["Trombone 1.pdf", "Trombone 2.pdf"]
+    assert treble_clef == ["Trombone 1 TC.pdf", "Trombone 2 TC.pdf"]
+
+def closing_window(pending):
+    window = types.SimpleNamespace(spooler=types.SimpleNamespace(pending=lambda: pending[0]), closing=False, shut_down_calls=0,
+                                   result_poll_interval=gui.sheetMusicPrinter.result_poll_interval, scheduled=[])
+    window.after = lambda ms, callback: window.scheduled.append(callback)
+    def shut_down():
+        window.shut_down_calls += 1
+    window.shut_down = shut_down
+    window.wait_for_spooler = lambda: gui.sheetMusicPrinter.wait_for_spooler(window)
+    return window
+
+def test_closing_waits_for_print_jobs_when_asked(monkeypatch):
+    monkeypatch.setattr(gui.messagebox, "askyesnocancel", lambda title, message: True)
+    pending = [2]
+    window = closing_window(pending)
+    gui.sheetMusicPrinter.close(window)
+    assert window.shut_down_calls == 0
+    pending[0] = 0
+    window.scheduled.pop()()
+    assert window.shut_down_calls == 1
+
+def test_closing_with_print_jobs_can_be_cancelled_or_forced(monkeypatch):
+    answers = [None, False]
+    monkeypatch.setattr(gui.messagebox, "askyesnocancel", lambda title, message: answers.pop(0))
+    window = closing_window([1])
+    gui.sheetMusicPrinter.close(window)
+    assert window.shut_down_calls == 0
+    gui.sheetMusicPrinter.close(window)
+    assert window.shut_down_calls == 1
+    assert window.scheduled == []
+
+def test_closing_without_print_jobs_does_not_ask(monkeypatch):
+    def ask(title, message):
+        raise AssertionError("asked with an empty print queue")
+    monkeypatch.setattr(gui.messagebox, "askyesnocancel", ask)
+    window = closing_window([0])
+    gui.sheetMusicPrinter.close(window)
+    assert window.shut_down_calls == 1